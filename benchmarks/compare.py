@@ -0,0 +1,32 @@
+import sys
+import json
+import argparse
+
+
+def load_results(path: str):
+    with open(path, "r") as f:
+        report = json.load(f)
+    return {(result["name"], result["size"]): result for result in report["results"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline", type=str)
+    parser.add_argument("candidate", type=str)
+    parser.add_argument("--threshold", type=float, default=1.1,
+                        help="slowdown ratio above which a benchmark counts as a regression")
+    args = parser.parse_args(argv)
+
+    baseline, candidate = load_results(args.baseline), load_results(args.candidate)
+    regressions = 0
+    for key in sorted(set(baseline) & set(candidate)):
+        ratio = candidate[key]["seconds"] / baseline[key]["seconds"]
+        status = "REGRESSION" if ratio > args.threshold else ""
+        regressions += ratio > args.threshold
+        print("{:<40} size={:<8} {:>10.4f} -> {:>10.4f} s  x{:.2f} {}".format(
+            key[0], key[1], baseline[key]["seconds"], candidate[key]["seconds"], ratio, status))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from typing import Callable, Dict, List
+import numpy as np
+from planaria.preprocessing import SkeletonWay, FeaturePreprocesser
+from planaria.preprocessing.read_data import parse_file, parse_file_arrays
+from planaria.modeling.shape_matching import ShapeMatcher
+from planaria.segmentation.segmentation import segment_planaria_photo
+from .synthetic import generate_skeleton_dataset, generate_photo_dataset
+
+
+def best_time(function: Callable, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def record(results: List[Dict], name: str, size: int, items: int, seconds: float) -> None:
+    results.append({"name": name, "size": size, "items": items, "seconds": seconds,
+                    "items_per_second": items / seconds if seconds > 0 else float("inf")})
+    print("{:<40} size={:<8} {:>10.4f} s  {:>12.1f} items/s".format(name, size, seconds,
+                                                                  results[-1]["items_per_second"]))
+
+
+def list_files(root_dir: str) -> List[str]:
+    return sorted(os.path.join(path, name) for path, _, names in os.walk(root_dir) for name in names)
+
+
+def bench_skeletons(results: List[Dict], work_dir: str, num_samples: int, num_pairs_skeletons: int,
+                    repeat: int) -> None:
+    skeleton_dir = generate_skeleton_dataset(os.path.join(work_dir, "skeletons_{}".format(num_samples)),
+                                             num_samples, seed=num_samples)
+    files = list_files(skeleton_dir)
+
+    seconds = best_time(lambda: [parse_file(f, diagram_type="skeleton_way") for f in files], repeat)
+    record(results, "parse_file", num_samples, len(files), seconds)
+    seconds = best_time(lambda: [parse_file_arrays(f, diagram_type="skeleton_way") for f in files], repeat)
+    record(results, "parse_file_arrays", num_samples, len(files), seconds)
+
+    parsed = [parse_file_arrays(f, diagram_type="skeleton_way") for f in files]
+    seconds = best_time(lambda: [SkeletonWay.from_arrays(num_terminals, way["points"][:, 0], way["points"][:, 1],
+                                                         way["radius"])
+                                 for num_terminals, _, _, way in parsed], repeat)
+    record(results, "straighten", num_samples, len(files), seconds)
+
+    skeletons = [SkeletonWay(f) for f in files]
+    seconds = best_time(lambda: [skeleton.get_features() for skeleton in skeletons], repeat)
+    record(results, "get_features", num_samples, len(files), seconds)
+
+    seconds = best_time(lambda: FeaturePreprocesser(skeleton_dir).preprocess_all(), repeat)
+    record(results, "FeaturePreprocesser.preprocess_all", num_samples, len(files), seconds)
+
+    pair_skeletons = skeletons[:num_pairs_skeletons]
+    pairs = [(a, b) for i, a in enumerate(pair_skeletons) for b in pair_skeletons[i + 1:]]
+    seconds = best_time(lambda: [ShapeMatcher.calculate_symmetric_diff_square(a, b) for a, b in pairs], repeat)
+    record(results, "calculate_symmetric_diff_square", num_samples, len(pairs), seconds)
+    seconds = best_time(lambda: ShapeMatcher.pairwise_matrix(pair_skeletons), repeat)
+    record(results, "ShapeMatcher.pairwise_matrix", num_samples, len(pairs), seconds)
+
+
+def bench_photos(results: List[Dict], work_dir: str, shape, num_photos: int, repeat: int) -> None:
+    photo_dir = generate_photo_dataset(os.path.join(work_dir, "photos_{}x{}".format(*shape)), num_photos, shape)
+    photos = list_files(photo_dir)
+    output_dir = os.path.join(work_dir, "segmentation_{}x{}".format(*shape))
+    os.makedirs(output_dir, exist_ok=True)
+    seconds = best_time(lambda: [segment_planaria_photo(photo, os.path.join(output_dir, os.path.basename(photo)))
+                                 for photo in photos], repeat)
+    record(results, "segment_planaria_photo", shape[0] * shape[1], len(photos), seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the planaria hot paths on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--pair-skeletons", type=int, default=60)
+    parser.add_argument("--photo-shapes", type=str, nargs="+", default=["600x800", "1200x1600"])
+    parser.add_argument("--num-photos", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--work-dir", type=str, default=None)
+    parser.add_argument("--output", type=str, default="benchmark_results.json")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for size in args.sizes:
+            bench_skeletons(results, work_dir, size, args.pair_skeletons, args.repeat)
+        for photo_shape in args.photo_shapes:
+            shape = tuple(int(side) for side in photo_shape.split("x"))
+            bench_photos(results, work_dir, shape, args.num_photos, args.repeat)
+
+    report = {"meta": {"python": sys.version.split()[0], "numpy": np.__version__, "platform": platform.platform(),
+                       "cpu_count": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import os
+from typing import Tuple
+import numpy as np
+from skimage import io, draw
+
+
+def format_nodes(x: np.ndarray, y: np.ndarray, radius: np.ndarray) -> str:
+    return "NODES\n" + "\n".join("{!r} {!r}\t{!r}".format(a, b, c)
+                                 for a, b, c in zip(x.tolist(), y.tolist(), radius.tolist()))
+
+
+def format_edges(x: np.ndarray, y: np.ndarray, radius: np.ndarray) -> str:
+    x, y, radius = x.tolist(), y.tolist(), radius.tolist()
+    return "EDGES\n" + "\n".join("{!r} {!r} {!r} {!r}\t{!r} {!r}".format(x[i], y[i], x[i + 1], y[i + 1],
+                                                                       radius[i], radius[i + 1])
+                                 for i in range(len(x) - 1))
+
+
+def synthetic_skeleton_way(rng: np.random.Generator, num_nodes: int,
+                           length: float = 600.0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    t = np.linspace(0, 1, num_nodes)
+    x = 100 + length * t + rng.normal(0, 1, num_nodes).cumsum()
+    y = 400 + 80 * np.sin(3 * t + rng.uniform(0, np.pi)) + rng.normal(0, 1, num_nodes)
+    # wide head, narrow tail
+    radius = 5 + 20 * np.sin(np.pi * t) ** 0.7 * (1.2 - 0.4 * t) + rng.uniform(0, 2, num_nodes)
+    return np.round(x, 3), np.round(y, 3), np.round(radius, 3)
+
+
+def write_skeleton_extra(path: str, rng: np.random.Generator, num_nodes: int, num_terminals: int = 2) -> None:
+    total_sep = "\n\n\n\n"
+    if num_nodes == 0:
+        with open(path, "w") as f:
+            f.write("TERMINALS\n{}".format(num_terminals))
+        return
+    x, y, radius = synthetic_skeleton_way(rng, num_nodes, length=rng.uniform(300, 800))
+    sections = ["TERMINALS\n{}".format(num_terminals), format_nodes(x, y, radius),
+                format_edges(x, y, radius), format_nodes(x, y, radius)]
+    with open(path, "w") as f:
+        f.write(total_sep.join(sections) + "\n")
+
+
+def generate_skeleton_dataset(root_dir: str, num_samples: int, num_classes: int = 3,
+                              num_nodes: Tuple[int, int] = (50, 300), num_terminals: Tuple[int, int] = (2, 6),
+                              empty_fraction: float = 0.0, seed: int = 0,
+                              skeleton_way_ending: str = "_skeleton_extra.txt") -> str:
+    rng = np.random.default_rng(seed)
+    for class_label in range(1, num_classes + 1):
+        os.makedirs(os.path.join(root_dir, "planaria {}".format(class_label)), exist_ok=True)
+    for i in range(num_samples):
+        class_dir = os.path.join(root_dir, "planaria {}".format(i % num_classes + 1))
+        nodes = 0 if rng.random() < empty_fraction else int(rng.integers(num_nodes[0], num_nodes[1] + 1))
+        terminals = int(rng.integers(num_terminals[0], num_terminals[1] + 1))
+        write_skeleton_extra(os.path.join(class_dir, "sample{}{}".format(i, skeleton_way_ending)),
+                             rng, nodes, terminals)
+    return root_dir
+
+
+def synthetic_photo(shape: Tuple[int, int], rng: np.random.Generator) -> np.ndarray:
+    image = np.full(shape + (3,), 200, dtype=np.uint8)
+    image = np.clip(image + rng.normal(0, 5, image.shape), 0, 255).astype(np.uint8)
+    center = (shape[0] * rng.uniform(0.4, 0.6), shape[1] * rng.uniform(0.4, 0.6))
+    radii = (shape[0] * rng.uniform(0.04, 0.08), shape[1] * rng.uniform(0.15, 0.3))
+    rows, cols = draw.ellipse(center[0], center[1], radii[0], radii[1], shape=shape,
+                              rotation=rng.uniform(-0.3, 0.3))
+    image[rows, cols] = 60
+    return image
+
+
+def generate_photo_dataset(root_dir: str, num_photos: int, shape: Tuple[int, int] = (1200, 1600),
+                           num_classes: int = 1, seed: int = 0) -> str:
+    rng = np.random.default_rng(seed)
+    for i in range(num_photos):
+        class_dir = os.path.join(root_dir, "planaria {}".format(i % num_classes + 1))
+        os.makedirs(class_dir, exist_ok=True)
+        io.imsave(os.path.join(class_dir, "photo{}.bmp".format(i)), synthetic_photo(shape, rng),
+                  check_contrast=False)
+    return root_dir
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+import pandas as pd
+from planaria.config import PLANARIA_PHOTO_DIR_PATH, PLANARIA_SEGMENTATION_DIR_PATH
+from planaria.instrumentation import InstrumentedTask, unwrap
+from planaria.pipeline import photo_features
+
+INGEST_LOG = "ingest_log.jsonl"
+
+
+def photo_signature(photo_path: str) -> Tuple[str, float]:
+    stat = os.stat(photo_path)
+    return "{}:{}".format(stat.st_size, stat.st_mtime_ns), stat.st_mtime
+
+
+def directory_class_label(directory: str) -> Optional[int]:
+    # "planaria N" directories hold class N, photos elsewhere have no label and are not ingested
+    label = directory.split(' ')[-1]
+    return int(label) if label.isdigit() else None
+
+
+def ingest_photo(photo_path: str, segmentation_path: str, skeleton_way_path: Optional[str],
+                 downscale: Optional[int]) -> Dict:
+    features = photo_features(photo_path, downscale=downscale, segmentation_path=segmentation_path,
+                              skeleton_way_path=skeleton_way_path)
+    # plain python numbers, so the record can go to the json log
+    return {key: float(feature) if isinstance(feature, float) else int(feature) for key, feature in features.items()}
+
+
+class IngestService:
+    # Polls photo_dir/<class directory>/*.bmp and pushes every new or changed photo through a bounded queue
+    # to n_jobs workers that segment it and compute its features in a process pool. A photo is taken once
+    # its mtime is settle_time seconds old, so files still being written are left for the next poll.
+    # Every outcome is appended to ingest_log.jsonl in segmentation_dir; on restart photos whose size and
+    # mtime match a logged outcome are skipped, so processing is idempotent. Failed photos are retried
+    # max_retries times with exponential delay and are tried again only when the file changes.
+    def __init__(self, photo_dir: str = PLANARIA_PHOTO_DIR_PATH,
+                 segmentation_dir: str = PLANARIA_SEGMENTATION_DIR_PATH, skeleton_dir: Optional[str] = None,
+                 n_jobs: int = 2, queue_size: int = 64, poll_interval: float = 1.0, settle_time: float = 1.0,
+                 max_retries: int = 3, retry_delay: float = 1.0, downscale: Optional[int] = None,
+                 on_result: Optional[Callable[[Dict], None]] = None):
+        self.photo_dir = photo_dir
+        self.segmentation_dir = segmentation_dir
+        self.skeleton_dir = skeleton_dir
+        self.n_jobs = n_jobs
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.downscale = downscale
+        self.on_result = on_result
+        self.log_path = os.path.join(segmentation_dir, INGEST_LOG)
+        self.records = dict()
+        self._pending = set()
+        self._retries = set()
+        self._queue = None
+        self._stop = None
+
+    def load_log(self) -> None:
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.records[record["photo"]] = record
+
+    def __write_record(self, record: Dict) -> None:
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.records[record["photo"]] = record
+
+    def list_photos(self):
+        for directory in sorted(os.listdir(self.photo_dir)):
+            photo_directory = os.path.join(self.photo_dir, directory)
+            if not os.path.isdir(photo_directory) or directory_class_label(directory) is None:
+                continue
+            for photo_name in sorted(os.listdir(photo_directory)):
+                if photo_name.endswith('bmp'):
+                    yield os.path.join(directory, photo_name)
+
+    def __scan(self):
+        # photos that are settled and have no outcome for their current signature
+        ready = []
+        now = time.time()
+        for photo in self.list_photos():
+            if photo in self._pending:
+                continue
+            try:
+                signature, mtime = photo_signature(os.path.join(self.photo_dir, photo))
+            except FileNotFoundError:
+                continue
+            record = self.records.get(photo)
+            if record is not None and record["signature"] == signature:
+                continue
+            if now - mtime >= self.settle_time:
+                ready.append((photo, signature))
+        return ready
+
+    def __task_args(self, photo: str):
+        directory, photo_name = os.path.split(photo)
+        segmentation_directory = os.path.join(self.segmentation_dir, directory)
+        os.makedirs(segmentation_directory, exist_ok=True)
+        skeleton_way_path = None
+        if self.skeleton_dir is not None:
+            os.makedirs(os.path.join(self.skeleton_dir, directory), exist_ok=True)
+            skeleton_way_path = os.path.join(self.skeleton_dir, directory,
+                                             os.path.splitext(photo_name)[0] + "_skeleton_extra.txt")
+        return (os.path.join(self.photo_dir, photo), os.path.join(segmentation_directory, photo_name),
+                skeleton_way_path, self.downscale)
+
+    def __finish(self, photo: str, signature: str, attempts: int, features: Optional[Dict],
+                 error: Optional[str]) -> None:
+        directory, photo_name = os.path.split(photo)
+        record = {"photo": photo, "signature": signature, "sample": os.path.splitext(photo_name)[0],
+                  "class_label": directory_class_label(directory), "status": "done" if error is None else "failed",
+                  "attempts": attempts, "features": features, "error": error, "time": time.time()}
+        self._pending.discard(photo)
+        self.__write_record(record)
+        if self.on_result is not None:
+            try:
+                self.on_result(record)
+            except Exception as e:
+                print("on_result failed for {}: {}: {}".format(photo, type(e).__name__, e), file=sys.stderr)
+
+    async def __retry(self, item, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self._queue.put(item)
+
+    async def __process(self, executor: ProcessPoolExecutor, photo: str, signature: str, attempt: int) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            task_result = await loop.run_in_executor(executor, InstrumentedTask(ingest_photo),
+                                                     *self.__task_args(photo))
+            features = unwrap(task_result)
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+            if attempt + 1 < self.max_retries:
+                retry = asyncio.ensure_future(self.__retry((photo, signature, attempt + 1),
+                                                           self.retry_delay * 2 ** attempt))
+                self._retries.add(retry)
+                retry.add_done_callback(self._retries.discard)
+            else:
+                self.__finish(photo, signature, attempt + 1, None, error)
+        else:
+            self.__finish(photo, signature, attempt + 1, features, None)
+
+    async def __worker(self, executor: ProcessPoolExecutor) -> None:
+        while True:
+            photo, signature, attempt = await self._queue.get()
+            try:
+                await self.__process(executor, photo, signature, attempt)
+            except Exception as e:
+                # a photo whose outcome cannot be recorded is dropped from this run, the worker goes on
+                self._pending.discard(photo)
+                print("ingest failed for {}: {}: {}".format(photo, type(e).__name__, e), file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+    async def run(self, stop_when_idle: bool = False) -> None:
+        os.makedirs(self.segmentation_dir, exist_ok=True)
+        self.load_log()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            workers = [asyncio.ensure_future(self.__worker(executor)) for _ in range(self.n_jobs)]
+            try:
+                while not self._stop.is_set():
+                    for photo, signature in await loop.run_in_executor(None, self.__scan):
+                        self._pending.add(photo)
+                        # blocks while the queue is full, so scanning never runs ahead of the workers
+                        await self._queue.put((photo, signature, 0))
+                    if stop_when_idle and not self._pending:
+                        break
+                    try:
+                        await asyncio.wait_for(self._stop.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                for task in workers + list(self._retries):
+                    task.cancel()
+                await asyncio.gather(*workers, *self._retries, return_exceptions=True)
+
+    def stop(self) -> None:
+        if self._stop is not None:
+            self._stop.set()
+
+    def get_features(self) -> pd.DataFrame:
+        res_dict = {"sample": [], "class_label": []}
+        for photo in sorted(self.records):
+            record = self.records[photo]
+            if record["status"] != "done":
+                continue
+            res_dict["sample"].append(record["sample"])
+            res_dict["class_label"].append(record["class_label"])
+            for key, feature in record["features"].items():
+                res_dict.setdefault(key, []).append(feature)
+        return pd.DataFrame(res_dict)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Segment and featurize planaria photos as they arrive.")
+    parser.add_argument("--photo-dir", type=str, default=PLANARIA_PHOTO_DIR_PATH)
+    parser.add_argument("--segmentation-dir", type=str, default=PLANARIA_SEGMENTATION_DIR_PATH)
+    parser.add_argument("--skeleton-dir", type=str, default=None)
+    parser.add_argument("--n-jobs", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--settle-time", type=float, default=1.0)
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--once", action="store_true", help="process the photos present and exit")
+    args = parser.parse_args(argv)
+
+    def print_record(record):
+        print("{} {}{}".format(record["status"], record["photo"],
+                               "" if record["error"] is None else ": " + record["error"]), flush=True)
+
+    service = IngestService(args.photo_dir, args.segmentation_dir, args.skeleton_dir, n_jobs=args.n_jobs,
+                            queue_size=args.queue_size, poll_interval=args.poll_interval,
+                            settle_time=args.settle_time, max_retries=args.max_retries, on_result=print_record)
+    try:
+        asyncio.run(service.run(stop_when_idle=args.once))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import sys
+import json
+import time
+import functools
+from typing import Callable, Dict, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_enabled = False
+_registry = dict()
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    _registry.clear()
+
+
+def peak_rss_bytes() -> int:
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _record(name: str, seconds: float, calls: int, items: int, peak_rss_increase: int) -> None:
+    # ru_maxrss is the high-water mark of the whole process, so a stage is charged only with how far
+    # it raised that mark; a stage running below an earlier peak reports 0
+    stats = _registry.get(name)
+    if stats is None:
+        _registry[name] = {"seconds": seconds, "calls": calls, "items": items,
+                           "peak_rss_increase_bytes": peak_rss_increase}
+        return
+    stats["seconds"] += seconds
+    stats["calls"] += calls
+    stats["items"] += items
+    stats["peak_rss_increase_bytes"] = max(stats["peak_rss_increase_bytes"], peak_rss_increase)
+
+
+class _Stage:
+    __slots__ = ("name", "items", "_start", "_start_rss")
+
+    def __init__(self, name: str, items: int):
+        self.name = name
+        self.items = items
+        self._start = 0.0
+        self._start_rss = 0
+
+    def __enter__(self):
+        self._start_rss = peak_rss_bytes()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _record(self.name, time.perf_counter() - self._start, 1, self.items, peak_rss_bytes() - self._start_rss)
+        return False
+
+
+class _NullStage:
+    __slots__ = ("items",)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name: str, items: int = 1):
+    # the shared no-op stage keeps the disabled path to a single flag check
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, items)
+
+
+def instrumented(name: Optional[str] = None, items: Optional[Callable] = None):
+    def decorator(function):
+        stage_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start_rss = peak_rss_bytes()
+            start = time.perf_counter()
+            res = function(*args, **kwargs)
+            num_items = items(res) if items is not None else 1
+            _record(stage_name, time.perf_counter() - start, 1, num_items, peak_rss_bytes() - start_rss)
+            return res
+        return wrapper
+    return decorator
+
+
+def snapshot() -> Dict[str, Dict]:
+    return {name: dict(stats) for name, stats in _registry.items()}
+
+
+def merge(stats_snapshot: Optional[Dict[str, Dict]]) -> None:
+    if not stats_snapshot:
+        return
+    for name, stats in stats_snapshot.items():
+        _record(name, stats["seconds"], stats["calls"], stats["items"], stats["peak_rss_increase_bytes"])
+
+
+class InstrumentedTask:
+    # Wraps a pool task so that worker stats travel back with its result; unwrap merges them.
+    def __init__(self, function: Callable):
+        self.function = function
+        self.enabled = _enabled
+
+    def __call__(self, *args):
+        if not self.enabled:
+            return self.function(*args), None
+        enable()
+        # stats of this task only; the registry is restored so an in-process call is not counted twice
+        saved = dict(_registry)
+        _registry.clear()
+        try:
+            res = self.function(*args)
+            return res, snapshot()
+        finally:
+            _registry.clear()
+            _registry.update(saved)
+
+
+def unwrap(task_result):
+    res, stats_snapshot = task_result
+    merge(stats_snapshot)
+    return res
+
+
+def format_summary() -> str:
+    row_format = "{:<36} {:>8} {:>10} {:>12.4f} {:>12.4f} {:>12.1f}"
+    lines = ["{:<36} {:>8} {:>10} {:>12} {:>12} {:>12}".format("stage", "calls", "items", "seconds", "ms/call",
+                                                               "peak +MB")]
+    for name, stats in sorted(_registry.items(), key=lambda item: -item[1]["seconds"]):
+        lines.append(row_format.format(
+            name, stats["calls"], stats["items"], stats["seconds"], 1000 * stats["seconds"] / max(stats["calls"], 1),
+            stats["peak_rss_increase_bytes"] / 2 ** 20))
+    return "\n".join(lines)
+
+
+def print_summary() -> None:
+    print(format_summary())
+
+
+def dump_json(path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(snapshot(), f, indent=2)
@@ -0,0 +1,199 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix
+from planaria.preprocessing import SkeletonWay
+from planaria.instrumentation import InstrumentedTask, unwrap
+from .shape_matching import pack_profiles, calculate_symmetric_diff_block, calculate_symmetric_diff_row, \
+    calculate_relative_diff
+
+METRICS = ["relative_diff", "absolute_diff"]
+
+_worker_state = dict()
+
+
+def _init_worker(x_all: np.ndarray, radius_all: np.ndarray, offsets: np.ndarray, squares: np.ndarray, metric: str):
+    _worker_state["profiles"] = (x_all, radius_all, offsets)
+    _worker_state["squares"] = squares
+    _worker_state["metric"] = metric
+
+
+def _distances_tile(tile: Tuple[int, int, int, int]) -> Tuple[Tuple[int, int, int, int], np.ndarray]:
+    row_start, row_end, col_start, col_end = tile
+    # only pairs with column > row are computed, the others stay NaN
+    block = calculate_symmetric_diff_block(*_worker_state["profiles"], row_start, row_end, col_start, col_end)
+    if _worker_state["metric"] == "relative_diff":
+        squares = _worker_state["squares"]
+        block = calculate_relative_diff(block, squares[row_start:row_end], squares[col_start:col_end])
+    return tile, block
+
+
+def merge_top_k(best_distances: np.ndarray, best_ids: np.ndarray, distances: np.ndarray,
+                ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # keeps the k smallest of the current top-k and the new candidates of every row, sorted by distance;
+    # NaN distances (self pairs, empty profiles) never get in
+    distances = np.where(np.isnan(distances), np.inf, distances)
+    all_distances = np.concatenate([best_distances, distances], axis=1)
+    all_ids = np.concatenate([best_ids, np.broadcast_to(ids, distances.shape)], axis=1)
+    order = np.argsort(all_distances, axis=1, kind="stable")[:, :best_distances.shape[1]]
+    return np.take_along_axis(all_distances, order, axis=1), np.take_along_axis(all_ids, order, axis=1)
+
+
+class NeighbourGraph:
+    # k nearest neighbours of every sample in CSR form: the neighbours of sample i are
+    # indices[indptr[i]:indptr[i + 1]] with their distances, closest first. Samples with fewer
+    # than k comparable samples (empty profiles) have shorter rows.
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, distances: np.ndarray, k: int,
+                 metric: str = "relative_diff"):
+        assert metric in METRICS
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.distances = np.asarray(distances, dtype=float)
+        self.k = int(k)
+        self.metric = metric
+
+    @classmethod
+    def from_top_k(cls, best_distances: np.ndarray, best_ids: np.ndarray, metric: str = "relative_diff"):
+        valid = np.isfinite(best_distances)
+        indptr = np.zeros(len(best_distances) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(valid.sum(axis=1))
+        return cls(indptr, best_ids[valid], best_distances[valid], best_distances.shape[1], metric)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def neighbours(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.distances[start:end]
+
+    def to_csr_matrix(self) -> csr_matrix:
+        return csr_matrix((self.distances, self.indices, self.indptr), shape=(len(self), len(self)))
+
+    def save(self, path: str) -> None:
+        np.savez(path, indptr=self.indptr, indices=self.indices, distances=self.distances, k=self.k,
+                 metric=self.metric)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(data["indptr"], data["indices"], data["distances"], int(data["k"]), str(data["metric"]))
+
+
+def build_neighbour_graph(skeletons: List[SkeletonWay], k: int = 5, metric: str = "relative_diff",
+                          n_jobs: int = 1, tile_size: int = 256) -> NeighbourGraph:
+    # Streams the upper triangle of the distance matrix tile by tile and merges every tile into the
+    # top-k of its rows and, transposed, of its columns, so memory stays at N * k plus one tile per
+    # worker and every distance is computed once.
+    assert metric in METRICS
+    num_skeletons = len(skeletons)
+    x_all, radius_all, offsets = pack_profiles(skeletons)
+    squares = np.array([skeleton.calculate_square() for skeleton in skeletons], dtype=float)
+    best_distances = np.full((num_skeletons, k), np.inf)
+    best_ids = np.full((num_skeletons, k), -1, dtype=np.int64)
+
+    bounds = list(range(0, num_skeletons, tile_size)) + [num_skeletons]
+    tiles = [(bounds[i], bounds[i + 1], bounds[j], bounds[j + 1])
+             for i in range(len(bounds) - 1) for j in range(i, len(bounds) - 1)]
+    init_args = (x_all, radius_all, offsets, squares, metric)
+    if n_jobs == 1 or len(tiles) <= 1:
+        _init_worker(*init_args)
+        results = map(_distances_tile, tiles)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=init_args)
+        results = (unwrap(task_result) for task_result in executor.map(InstrumentedTask(_distances_tile), tiles))
+    try:
+        for (row_start, row_end, col_start, col_end), block in results:
+            rows, cols = slice(row_start, row_end), slice(col_start, col_end)
+            best_distances[rows], best_ids[rows] = merge_top_k(best_distances[rows], best_ids[rows], block,
+                                                               np.arange(col_start, col_end))
+            best_distances[cols], best_ids[cols] = merge_top_k(best_distances[cols], best_ids[cols], block.T,
+                                                               np.arange(row_start, row_end))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        else:
+            # the serial path filled the worker state of this process, do not keep the profiles alive
+            _worker_state.clear()
+    return NeighbourGraph.from_top_k(best_distances, best_ids, metric)
+
+
+def vote(neighbour_labels: np.ndarray, neighbour_distances: np.ndarray, neighbour_rows: np.ndarray,
+         num_rows: int, classes: np.ndarray, weights: str = "uniform") -> np.ndarray:
+    # majority (or 1 / distance weighted) vote per row, ties go to the smaller label;
+    # rows without neighbours get -1
+    assert weights in ["uniform", "distance"]
+    class_ids = np.searchsorted(classes, neighbour_labels)
+    if weights == "uniform":
+        votes_weights = np.ones(len(class_ids))
+    else:
+        with np.errstate(divide="ignore"):
+            votes_weights = 1 / neighbour_distances
+        # exact matches outvote everything else
+        votes_weights = np.where(np.isinf(votes_weights), 1e300, votes_weights)
+    votes = np.bincount(neighbour_rows * len(classes) + class_ids, weights=votes_weights,
+                        minlength=num_rows * len(classes)).reshape(num_rows, len(classes))
+    has_neighbours = np.bincount(neighbour_rows, minlength=num_rows) > 0
+    return np.where(has_neighbours, classes[np.argmax(votes, axis=1)], -1)
+
+
+class NeighbourClassifier:
+    # k-NN on shape distances. fit builds the neighbour graph of the references (or takes a saved one),
+    # so leave-one-out evaluation reads the graph and never recomputes a distance.
+    def __init__(self, k: int = 5, metric: str = "relative_diff", weights: str = "uniform", n_jobs: int = 1,
+                 tile_size: int = 256):
+        assert metric in METRICS
+        assert weights in ["uniform", "distance"]
+        self.k = k
+        self.metric = metric
+        self.weights = weights
+        self.n_jobs = n_jobs
+        self.tile_size = tile_size
+        self.graph = None
+
+    def fit(self, skeletons: List[SkeletonWay], class_labels: List[int], graph: Optional[NeighbourGraph] = None):
+        if graph is None:
+            graph = build_neighbour_graph(skeletons, self.k, self.metric, self.n_jobs, self.tile_size)
+        assert len(graph) == len(skeletons) and graph.k >= self.k and graph.metric == self.metric
+        self.graph = graph
+        self._x_all, self._radius_all, self._offsets = pack_profiles(skeletons)
+        self._squares = np.array([skeleton.calculate_square() for skeleton in skeletons], dtype=float)
+        self.class_labels = np.asarray(class_labels, dtype=np.int64)
+        self.classes = np.unique(self.class_labels)
+        return self
+
+    def kneighbours(self, skeletons: List[SkeletonWay]) -> Tuple[np.ndarray, np.ndarray]:
+        # (len(skeletons), k) neighbour ids and distances to the references, -1 and inf where missing
+        best_distances = np.full((len(skeletons), self.k), np.inf)
+        best_ids = np.full((len(skeletons), self.k), -1, dtype=np.int64)
+        references = np.arange(len(self.class_labels))
+        for i, skeleton in enumerate(skeletons):
+            x, radius = skeleton.get_straight_profile()
+            distances = calculate_symmetric_diff_row(x, radius, self._x_all, self._radius_all, self._offsets)
+            if self.metric == "relative_diff":
+                distances = calculate_relative_diff(distances[None, :], np.array([skeleton.calculate_square()]),
+                                                    self._squares)[0]
+            best_distances[i:i + 1], best_ids[i:i + 1] = merge_top_k(best_distances[i:i + 1], best_ids[i:i + 1],
+                                                                     distances[None, :], references)
+        return best_ids, best_distances
+
+    def __vote(self, best_ids: np.ndarray, best_distances: np.ndarray) -> np.ndarray:
+        found = best_ids >= 0
+        rows = np.repeat(np.arange(len(best_ids)), found.sum(axis=1))
+        return vote(self.class_labels[best_ids[found]], best_distances[found], rows, len(best_ids), self.classes,
+                    self.weights)
+
+    def predict(self, skeletons: List[SkeletonWay]) -> np.ndarray:
+        return self.__vote(*self.kneighbours(skeletons))
+
+    def leave_one_out_predict(self) -> np.ndarray:
+        # the graph never links a sample to itself, so its first k neighbours are the leave-one-out ones
+        counts = np.minimum(np.diff(self.graph.indptr), self.k)
+        rows = np.repeat(np.arange(len(self.graph)), counts)
+        positions = self.graph.indptr[rows] + np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return vote(self.class_labels[self.graph.indices[positions]], self.graph.distances[positions], rows,
+                    len(self.graph), self.classes, self.weights)
+
+    def leave_one_out_accuracy(self) -> float:
+        # samples that have no neighbours count as errors
+        return float(np.mean(self.leave_one_out_predict() == self.class_labels))
@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Tuple
+import numpy as np
+from planaria.preprocessing import SkeletonWay
+from planaria.instrumentation import InstrumentedTask, unwrap
+from .shape_matching import pack_profiles, calculate_symmetric_diff_block, calculate_relative_diff
+
+_worker_state = dict()
+
+
+def _open_matrix(path: str, num_skeletons: int, mode: str) -> np.memmap:
+    return np.memmap(path, dtype=np.float64, mode=mode, shape=(num_skeletons, num_skeletons))
+
+
+def _init_worker(work_dir: str, num_skeletons: int):
+    # profiles are memory-mapped once per worker, tiles only pass their bounds
+    _worker_state["x_all"] = np.load(os.path.join(work_dir, "profiles_x.npy"), mmap_mode="r")
+    _worker_state["radius_all"] = np.load(os.path.join(work_dir, "profiles_radius.npy"), mmap_mode="r")
+    _worker_state["offsets"] = np.load(os.path.join(work_dir, "profiles_offsets.npy"))
+    _worker_state["squares"] = np.load(os.path.join(work_dir, "squares.npy"))
+    _worker_state["absolute_diff"] = _open_matrix(os.path.join(work_dir, "absolute_diff.dat"), num_skeletons, "r+")
+    _worker_state["relative_diff"] = _open_matrix(os.path.join(work_dir, "relative_diff.dat"), num_skeletons, "r+")
+
+
+def _match_tile(tile: Tuple[int, int, int, int, int]) -> int:
+    tile_id, row_start, row_end, col_start, col_end = tile
+    x_all, radius_all, offsets = _worker_state["x_all"], _worker_state["radius_all"], _worker_state["offsets"]
+    squares = _worker_state["squares"]
+    absolute_diff, relative_diff = _worker_state["absolute_diff"], _worker_state["relative_diff"]
+
+    block = calculate_symmetric_diff_block(x_all, radius_all, offsets, row_start, row_end, col_start, col_end)
+    if row_start == col_start:
+        # diagonal tile: mirror the upper triangle inside the tile and fill the diagonal
+        lower = np.tril_indices(row_end - row_start, -1)
+        block[lower] = block.T[lower]
+        valid = np.diff(offsets[row_start:row_end + 1]) > 0
+        block[np.arange(len(valid)), np.arange(len(valid))] = np.where(valid, 0.0, np.nan)
+    block_relative = calculate_relative_diff(block, squares[row_start:row_end], squares[col_start:col_end])
+
+    absolute_diff[row_start:row_end, col_start:col_end] = block
+    relative_diff[row_start:row_end, col_start:col_end] = block_relative
+    if row_start != col_start:
+        absolute_diff[col_start:col_end, row_start:row_end] = block.T
+        relative_diff[col_start:col_end, row_start:row_end] = block_relative.T
+    absolute_diff.flush()
+    relative_diff.flush()
+    return tile_id
+
+
+class ParallelShapeMatcher:
+    def __init__(self, work_dir: str, n_jobs: Optional[int] = None, tile_size: int = 256):
+        self.work_dir = work_dir
+        self.n_jobs = n_jobs if n_jobs is not None else os.cpu_count()
+        self.tile_size = tile_size
+
+    def __path(self, name: str) -> str:
+        return os.path.join(self.work_dir, name)
+
+    @staticmethod
+    def __fingerprint(x_all: np.ndarray, radius_all: np.ndarray, offsets: np.ndarray) -> str:
+        digest = hashlib.sha1()
+        for array in (x_all, radius_all, offsets):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def __tiles(self, num_skeletons: int) -> List[Tuple[int, int, int, int, int]]:
+        bounds = list(range(0, num_skeletons, self.tile_size)) + [num_skeletons]
+        tiles = []
+        for i in range(len(bounds) - 1):
+            for j in range(i, len(bounds) - 1):
+                tiles.append((len(tiles), bounds[i], bounds[i + 1], bounds[j], bounds[j + 1]))
+        return tiles
+
+    def __prepare(self, skeletons: List[SkeletonWay], num_tiles: int) -> np.memmap:
+        os.makedirs(self.work_dir, exist_ok=True)
+        num_skeletons = len(skeletons)
+        x_all, radius_all, offsets = pack_profiles(skeletons)
+        meta = {"num_skeletons": num_skeletons, "tile_size": self.tile_size,
+                "fingerprint": self.__fingerprint(x_all, radius_all, offsets)}
+        meta_path = self.__path("meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                if json.load(f) == meta:
+                    return np.memmap(self.__path("tiles_done.dat"), dtype=np.uint8, mode="r+", shape=(num_tiles,))
+            os.remove(meta_path)
+
+        squares = np.array([skeleton.calculate_square() for skeleton in skeletons], dtype=float)
+        np.save(self.__path("profiles_x.npy"), x_all)
+        np.save(self.__path("profiles_radius.npy"), radius_all)
+        np.save(self.__path("profiles_offsets.npy"), offsets)
+        np.save(self.__path("squares.npy"), squares)
+        for name in ("absolute_diff.dat", "relative_diff.dat"):
+            _open_matrix(self.__path(name), num_skeletons, "w+").flush()
+        tiles_done = np.memmap(self.__path("tiles_done.dat"), dtype=np.uint8, mode="w+", shape=(num_tiles,))
+        tiles_done.flush()
+        # metadata goes last, so a run interrupted during setup starts from scratch
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+        return tiles_done
+
+    def pairwise_matrix(self, skeletons: List[SkeletonWay]) -> Tuple[np.memmap, np.memmap]:
+        num_skeletons = len(skeletons)
+        if num_skeletons == 0:
+            return np.empty((0, 0)), np.empty((0, 0))
+        tiles = self.__tiles(num_skeletons)
+        tiles_done = self.__prepare(skeletons, len(tiles))
+        pending = [tile for tile in tiles if not tiles_done[tile[0]]]
+
+        if pending:
+            with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker,
+                                     initargs=(self.work_dir, num_skeletons)) as executor:
+                task = InstrumentedTask(_match_tile)
+                futures = [executor.submit(task, tile) for tile in pending]
+                for future in as_completed(futures):
+                    tiles_done[unwrap(future.result())] = 1
+                    tiles_done.flush()
+
+        absolute_diff = _open_matrix(self.__path("absolute_diff.dat"), num_skeletons, "r")
+        relative_diff = _open_matrix(self.__path("relative_diff.dat"), num_skeletons, "r")
+        return absolute_diff, relative_diff
@@ -0,0 +1,85 @@
+from typing import Dict, List, Optional
+import numpy as np
+from planaria.preprocessing import SkeletonWay
+from .shape_matching import ShapeMatcher
+
+
+class ProfileEmbedder:
+    # Radius profiles are resampled on the absolute grid 0, step, ..., max_length with zero radius past
+    # the skeleton end, so the L1 distance between embeddings approximates the symmetric difference area.
+    # The error shrinks with the step down to a floor set by the exact distance itself: there the shorter
+    # profile falls to zero at the next node of the other one, here at the next grid point.
+    # approximation_error reports the error against calculate_symmetric_diff_square on sampled pairs.
+    # transform raises on profiles longer than max_length; with clip=True they are cut at max_length,
+    # which under-reports their difference to the others.
+    def __init__(self, num_points: int = 256, max_length: Optional[float] = None, clip: bool = False):
+        self.num_points = num_points
+        self.max_length = max_length
+        self.clip = clip
+
+    @property
+    def step(self) -> float:
+        return self.max_length / (self.num_points - 1)
+
+    def fit(self, skeletons: List[SkeletonWay]):
+        lengths = np.array([skeleton.calculate_length() for skeleton in skeletons], dtype=float)
+        self.max_length = float(np.nanmax(lengths))
+        return self
+
+    def transform(self, skeletons: List[SkeletonWay]) -> np.ndarray:
+        assert self.max_length is not None
+        grid = np.linspace(0.0, self.max_length, self.num_points)
+        embeddings = np.full((len(skeletons), self.num_points), np.nan, dtype=np.float32)
+        for i, skeleton in enumerate(skeletons):
+            x, radius = skeleton.get_straight_profile()
+            if len(x) == 0:
+                continue
+            if x[-1] > self.max_length and not self.clip:
+                raise ValueError("skeleton {} is {} long, the embedding grid ends at {}; refit or pass clip=True"
+                                 .format(i, x[-1], self.max_length))
+            embeddings[i] = np.interp(grid, x, radius, right=0.0)
+        return embeddings
+
+    def fit_transform(self, skeletons: List[SkeletonWay]) -> np.ndarray:
+        return self.fit(skeletons).transform(skeletons)
+
+    def pairwise_distances(self, embeddings_1: np.ndarray, embeddings_2: Optional[np.ndarray] = None,
+                           max_chunk_elements: int = 1 << 24) -> np.ndarray:
+        if embeddings_2 is None:
+            embeddings_2 = embeddings_1
+        # trapezoid weights of the grid, doubled for both sides of the skeleton axis
+        weights = np.full(self.num_points, 2 * self.step, dtype=np.float32)
+        weights[[0, -1]] /= 2
+        res = np.empty((len(embeddings_1), len(embeddings_2)), dtype=np.float32)
+        chunk_size = max(1, max_chunk_elements // max(1, len(embeddings_2) * self.num_points))
+        for start in range(0, len(embeddings_1), chunk_size):
+            chunk = np.asarray(embeddings_1[start:start + chunk_size])
+            res[start:start + chunk_size] = np.abs(chunk[:, None, :] - embeddings_2[None, :, :]) @ weights
+        return res
+
+    def approximation_error(self, skeletons: List[SkeletonWay], num_pairs: int = 200,
+                            seed: int = 0) -> Dict[str, float]:
+        valid = [skeleton for skeleton in skeletons if not np.isnan(skeleton.calculate_length())]
+        rng = np.random.default_rng(seed)
+        pairs = rng.integers(len(valid), size=(num_pairs, 2))
+        embeddings = self.transform(valid)
+        exact, approximate = [], []
+        for i, j in pairs:
+            exact.append(ShapeMatcher.calculate_symmetric_diff_square(valid[i], valid[j]))
+            approximate.append(self.pairwise_distances(embeddings[i:i + 1], embeddings[j:j + 1])[0, 0])
+        exact, approximate = np.array(exact), np.array(approximate, dtype=float)
+        absolute_error = np.abs(approximate - exact)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            relative_error = absolute_error[exact > 0] / exact[exact > 0]
+        return {"mean_absolute_error": float(absolute_error.mean()),
+                "max_absolute_error": float(absolute_error.max()),
+                "mean_relative_error": float(relative_error.mean()) if len(relative_error) else 0.0,
+                "max_relative_error": float(relative_error.max()) if len(relative_error) else 0.0}
+
+
+def save_embeddings(path: str, embeddings: np.ndarray) -> None:
+    np.save(path, np.ascontiguousarray(embeddings, dtype=np.float32))
+
+
+def load_embeddings(path: str) -> np.ndarray:
+    return np.load(path, mmap_mode="r")
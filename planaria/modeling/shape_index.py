@@ -0,0 +1,184 @@
+import heapq
+from typing import List, Tuple
+import numpy as np
+from planaria.preprocessing import SkeletonWay
+from .shape_matching import pack_profiles, calculate_symmetric_diff_row, calculate_step_tail_correction
+
+
+class VPNode:
+    __slots__ = ("vantage_point", "median", "outside_min", "outside_max", "inside", "outside", "leaf_ids",
+                 "end_radius_max", "edge_max")
+
+    def __init__(self, vantage_point: int = -1, median: float = 0.0, outside_min: float = 0.0,
+                 outside_max: float = 0.0, inside=None, outside=None, leaf_ids: np.ndarray = None,
+                 end_radius_max: float = 0.0, edge_max: float = 0.0):
+        self.vantage_point = vantage_point
+        self.median = median
+        self.outside_min = outside_min
+        self.outside_max = outside_max
+        self.inside = inside
+        self.outside = outside
+        self.leaf_ids = leaf_ids
+        # largest end radius and edge length in the subtree, they bound the tail correction
+        self.end_radius_max = end_radius_max
+        self.edge_max = edge_max
+
+    def is_leaf(self) -> bool:
+        return self.leaf_ids is not None
+
+
+class ShapeIndex:
+    # Exact neighbours under the distance of calculate_symmetric_diff_square. That distance is not a
+    # metric: the shorter profile ramps to zero at the next node of the longer one. The tree is built on
+    # the step distance (shorter profile drops to zero at its end), an L1 metric that differs from it by
+    # at most end radius of the shorter * edge length of the longer; every bound is widened by that, and
+    # |square_1 - square_2| bounds the step distance.
+    def __init__(self, skeletons: List[SkeletonWay], leaf_size: int = 16, seed: int = 0):
+        self._x_all, self._radius_all, self._offsets = pack_profiles(skeletons)
+        self._squares = np.array([skeleton.calculate_square() for skeleton in skeletons], dtype=float)
+        self._end_radius, self._max_edge = self.__tail_bounds(self._x_all, self._radius_all, self._offsets)
+        self._leaf_size = leaf_size
+        self._rng = np.random.default_rng(seed)
+        self.num_distance_evaluations = 0
+        # empty skeletons have no profile and are not indexed
+        ids = np.flatnonzero(np.diff(self._offsets) > 0)
+        self._root = self.__build(ids) if len(ids) else None
+        self.build_distance_evaluations = self.num_distance_evaluations
+
+    def __len__(self):
+        return len(self._squares)
+
+    @staticmethod
+    def __tail_bounds(x_all: np.ndarray, radius_all: np.ndarray,
+                      offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # end radius and longest edge of every profile, zero for empty ones
+        non_empty = np.diff(offsets) > 0
+        end_radius, max_edge = np.zeros(len(offsets) - 1), np.zeros(len(offsets) - 1)
+        if non_empty.any():
+            end_radius[non_empty] = radius_all[offsets[1:][non_empty] - 1]
+            edges = np.zeros(len(x_all))
+            edges[1:] = np.diff(x_all)
+            edges[offsets[:-1][non_empty]] = 0.0
+            max_edge[non_empty] = np.maximum.reduceat(edges, offsets[:-1][non_empty])
+        return end_radius, max_edge
+
+    def __distances(self, x: np.ndarray, radius: np.ndarray, ids: np.ndarray,
+                    step: bool = False) -> np.ndarray:
+        # distances of calculate_symmetric_diff_square, or step distances when step is set
+        self.num_distance_evaluations += len(ids)
+        if len(ids) == 0:
+            return np.empty(0)
+        starts, ends = self._offsets[ids], self._offsets[ids + 1]
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(ends - starts)
+        x_others = np.concatenate([self._x_all[start:end] for start, end in zip(starts, ends)])
+        radius_others = np.concatenate([self._radius_all[start:end] for start, end in zip(starts, ends)])
+        distances = calculate_symmetric_diff_row(x, radius, x_others, radius_others, offsets)
+        if not step:
+            return distances
+        return distances + calculate_step_tail_correction(x, radius, x_others, radius_others, offsets)
+
+    def __vantage_distances(self, x: np.ndarray, radius: np.ndarray, vantage_point: int) -> Tuple[float, float]:
+        # both distances from one kernel call
+        start, end = self._offsets[vantage_point], self._offsets[vantage_point + 1]
+        offsets = np.array([0, end - start], dtype=np.int64)
+        x_others, radius_others = self._x_all[start:end], self._radius_all[start:end]
+        self.num_distance_evaluations += 1
+        distance = calculate_symmetric_diff_row(x, radius, x_others, radius_others, offsets)[0]
+        return distance, distance + calculate_step_tail_correction(x, radius, x_others, radius_others, offsets)[0]
+
+    @staticmethod
+    def __tail_slack(end_radius: float, max_edge: float, end_radius_others, max_edge_others):
+        # upper bound of |distance - step distance|: either profile may be the shorter one
+        return np.maximum(end_radius * max_edge_others, end_radius_others * max_edge)
+
+    def __profile(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return self._x_all[start:end], self._radius_all[start:end]
+
+    def __build(self, ids: np.ndarray) -> VPNode:
+        tail_bounds = {"end_radius_max": float(self._end_radius[ids].max()),
+                       "edge_max": float(self._max_edge[ids].max())}
+        if len(ids) <= self._leaf_size:
+            return VPNode(leaf_ids=ids, **tail_bounds)
+        pos = self._rng.integers(len(ids))
+        vantage_point, others = ids[pos], np.delete(ids, pos)
+        # the tree is laid out by the step distance, the one that obeys the triangle inequality
+        distances = self.__distances(*self.__profile(vantage_point), others, step=True)
+        median = float(np.median(distances))
+        inside_mask = distances <= median
+        outside_distances = distances[~inside_mask]
+        node = VPNode(vantage_point=vantage_point, median=median, **tail_bounds)
+        node.inside = self.__build(others[inside_mask])
+        if len(outside_distances):
+            node.outside_min, node.outside_max = float(outside_distances.min()), float(outside_distances.max())
+            node.outside = self.__build(others[~inside_mask])
+        return node
+
+    def __search(self, x: np.ndarray, radius: np.ndarray, square: float, bound, visit) -> None:
+        # bound() returns the current search radius, visit(ids, distances) collects candidates
+        end_radius, max_edge = radius[-1], (np.diff(x).max() if len(x) > 1 else 0.0)
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            if node.is_leaf():
+                ids = node.leaf_ids
+                # |square_1 - square_2| never exceeds the step distance
+                slack = self.__tail_slack(end_radius, max_edge, self._end_radius[ids], self._max_edge[ids])
+                ids = ids[np.abs(self._squares[ids] - square) <= bound() + slack]
+                visit(ids, self.__distances(x, radius, ids))
+                continue
+            distance, step_distance = self.__vantage_distances(x, radius, node.vantage_point)
+            visit(np.array([node.vantage_point]), np.array([distance]))
+            # a subtree is skipped only if its step distances exceed the search radius plus the slack
+            step_bound = bound() + self.__tail_slack(end_radius, max_edge, node.end_radius_max, node.edge_max)
+            children = []
+            if step_distance - step_bound <= node.median:
+                children.append((step_distance <= node.median, node.inside))
+            if node.outside is not None and node.outside_min <= step_distance + step_bound \
+                    and step_distance - step_bound <= node.outside_max:
+                children.append((step_distance > node.median, node.outside))
+            # the subtree that contains the query is pushed last to be searched first
+            for _, child in sorted(children, key=lambda child: child[0]):
+                stack.append(child)
+
+    def __query_profile(self, skeleton: SkeletonWay) -> Tuple[np.ndarray, np.ndarray, float]:
+        x, radius = skeleton.get_straight_profile()
+        if len(x) == 0:
+            raise ValueError("skeleton has an empty skeleton way")
+        return x, radius, skeleton.calculate_square()
+
+    def query(self, skeleton: SkeletonWay, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        x, radius, square = self.__query_profile(skeleton)
+        self.num_distance_evaluations = 0
+        heap = []
+
+        def bound():
+            return -heap[0][0] if len(heap) == k else np.inf
+
+        def visit(ids, distances):
+            for i, distance in zip(ids.tolist(), distances.tolist()):
+                if len(heap) < k:
+                    heapq.heappush(heap, (-distance, i))
+                elif distance < -heap[0][0]:
+                    heapq.heapreplace(heap, (-distance, i))
+
+        self.__search(x, radius, square, bound, visit)
+        res = sorted((-neg_distance, i) for neg_distance, i in heap)
+        return np.array([i for _, i in res], dtype=np.int64), np.array([distance for distance, _ in res])
+
+    def range_query(self, skeleton: SkeletonWay, max_distance: float) -> Tuple[np.ndarray, np.ndarray]:
+        x, radius, square = self.__query_profile(skeleton)
+        self.num_distance_evaluations = 0
+        found_ids, found_distances = [], []
+
+        def visit(ids, distances):
+            within = distances <= max_distance
+            found_ids.append(ids[within])
+            found_distances.append(distances[within])
+
+        self.__search(x, radius, square, lambda: max_distance, visit)
+        ids = np.concatenate(found_ids + [np.empty(0, dtype=np.int64)]).astype(np.int64)
+        distances = np.concatenate(found_distances + [np.empty(0)])
+        order = np.argsort(distances, kind="stable")
+        return ids[order], distances[order]
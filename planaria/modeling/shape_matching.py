@@ -1,4 +1,7 @@
+from typing import List, Optional, Tuple
+import numpy as np
 from planaria.preprocessing import SkeletonWay
+from planaria.instrumentation import instrumented
 
 
 def node_constructor(x, y, radius):
@@ -46,8 +49,8 @@ def unite_shapes(shape_1, shape_2):
         pointer_1 += 1
     while pointer_2 < len(shape_2):
         x_2, rad_2 = shape_2[pointer_2]["point"][0], shape_2[pointer_2]["radius"]
-        shape_1_unite.append(node_constructor(x_2, 0, rad_2))
-        shape_2_unite.append(node_constructor(x_2, 0, 0))
+        shape_1_unite.append(node_constructor(x_2, 0, 0))
+        shape_2_unite.append(node_constructor(x_2, 0, rad_2))
         pointer_2 += 1
     return shape_1_unite, shape_2_unite
 
@@ -93,11 +96,242 @@ def calculate_symmetric_diff_part(node_left_1, node_left_2, node_right_1, node_r
     return calculate_symmetric_integral(k_1, k_2, a_1, a_2, a=x_1_left, b=x_1_right)
 
 
+def calculate_abs_linear_integrals(d_left: np.ndarray, d_right: np.ndarray, edge_length: np.ndarray) -> np.ndarray:
+    # closed-form integral of |d| for d linear from d_left to d_right over edge_length
+    same_sign = d_left * d_right >= 0
+    abs_sum = np.abs(d_left) + np.abs(d_right)
+    safe_abs_sum = np.where(same_sign, 1.0, abs_sum)
+    crossing = (d_left ** 2 + d_right ** 2) / (2 * safe_abs_sum)
+    return edge_length * np.where(same_sign, np.abs(d_left + d_right) / 2, crossing)
+
+
+def calculate_abs_diff_integrals(diff: np.ndarray, x: np.ndarray) -> np.ndarray:
+    # closed-form integral of |d| for a linear d on every [x[i], x[i + 1]]
+    return calculate_abs_linear_integrals(diff[:-1], diff[1:], np.diff(x))
+
+
+def pack_profiles(skeletons: List[SkeletonWay]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    profiles = [skeleton.get_straight_profile() for skeleton in skeletons]
+    offsets = np.zeros(len(profiles) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x, _ in profiles])
+    x_all = np.concatenate([x for x, _ in profiles] + [np.empty(0)])
+    radius_all = np.concatenate([radius for _, radius in profiles] + [np.empty(0)])
+    return x_all, radius_all, offsets
+
+
+@instrumented("symmetric_diff_row", items=len)
+def calculate_symmetric_diff_row(x: np.ndarray, radius: np.ndarray,
+                                 x_others: np.ndarray, radius_others: np.ndarray,
+                                 offsets: np.ndarray) -> np.ndarray:
+    # symmetric difference of one profile against profiles concatenated in x_others with offsets
+    num_others = len(offsets) - 1
+    others_lens = np.diff(offsets)
+    res = np.full(num_others, np.nan)
+    if len(x) == 0 or len(x_others) == 0:
+        return res
+    others_ids = np.repeat(np.arange(num_others), others_lens)
+    others_pos = np.arange(len(x_others)) - (offsets[others_ids] - offsets[0])
+    # merge without sorting: count nodes of the other sequence before each node,
+    # at equal x nodes of the other profile go first so merged breakpoints keep their own radius
+    self_before_others = np.searchsorted(x, x_others, side="left")
+    others_before_self = np.bincount(others_ids * (len(x) + 1) + self_before_others,
+                                     minlength=num_others * (len(x) + 1)).reshape(num_others, len(x) + 1)
+    others_before_self = np.cumsum(others_before_self, axis=1)[:, :len(x)]
+    pair_starts = offsets[:-1] - offsets[0] + np.arange(num_others) * len(x)
+
+    others_merged = pair_starts[others_ids] + others_pos + self_before_others
+    self_merged = (pair_starts[:, None] + np.arange(len(x))[None, :] + others_before_self).ravel()
+    merged_len = len(x_others) + num_others * len(x)
+    pair_ids = np.empty(merged_len, dtype=np.int64)
+    pair_ids[others_merged] = others_ids
+    pair_ids[self_merged] = np.repeat(np.arange(num_others), len(x))
+    grid_x = np.empty(merged_len)
+    grid_x[others_merged] = x_others
+    grid_x[self_merged] = np.tile(x, num_others)
+    # number of nodes of the other profile at or before every merged breakpoint
+    others_count = np.empty(merged_len, dtype=np.int64)
+    others_count[others_merged] = others_pos + 1
+    others_count[self_merged] = others_before_self.ravel()
+
+    keep = np.ones(len(grid_x), dtype=bool)
+    keep[1:] = (pair_ids[1:] != pair_ids[:-1]) | (grid_x[1:] != grid_x[:-1])
+    pair_ids, grid_x, others_count = pair_ids[keep], grid_x[keep], others_count[keep]
+
+    # shorter profile continues linearly to zero radius, as in unite_shapes
+    radius_grid = np.interp(grid_x, x, radius, right=0.0)
+    left = np.maximum(offsets[pair_ids] - offsets[0] + others_count - 1, 0)
+    inside = others_count < others_lens[pair_ids]
+    right = np.where(inside, left + 1, left)
+    x_left, x_right = x_others[left], x_others[right]
+    koef = np.where(inside, (grid_x - x_left) / np.where(inside, x_right - x_left, 1.0), 0.0)
+    radius_others_grid = koef * (radius_others[right] - radius_others[left]) + radius_others[left]
+    radius_others_grid = np.where(inside | (grid_x == x_left), radius_others_grid, 0.0)
+
+    segments = calculate_abs_diff_integrals(radius_grid - radius_others_grid, grid_x)
+    same_pair = pair_ids[1:] == pair_ids[:-1]
+    diff = 2 * np.bincount(pair_ids[:-1][same_pair], weights=segments[same_pair], minlength=num_others)
+    res[others_lens > 0] = diff[others_lens > 0]
+    return res
+
+
+def calculate_step_tail_correction(x: np.ndarray, radius: np.ndarray,
+                                   x_others: np.ndarray, radius_others: np.ndarray,
+                                   offsets: np.ndarray) -> np.ndarray:
+    # Step distance minus the distance of calculate_symmetric_diff_row for every other profile. The step
+    # distance drops the shorter profile to zero at its end instead of ramping it to the next node of the
+    # longer one, which makes it an L1 metric. Only [end of shorter, next node of longer] differs, both
+    # profiles are linear there and the difference never exceeds the ramp area: end radius * edge length.
+    num_others = len(offsets) - 1
+    others_lens = np.diff(offsets)
+    res = np.full(num_others, np.nan)
+    if len(x) == 0 or len(x_others) == 0:
+        return res
+    valid = others_lens > 0
+    others_ids = np.repeat(np.arange(num_others), others_lens)
+    starts, ends = offsets[:-1] - offsets[0], offsets[1:] - offsets[0] - 1
+    length, others_length = x[-1], np.where(valid, x_others[np.maximum(ends, 0)], np.inf)
+
+    # self is shorter: the other profile is linear between the nodes around the end of self
+    others_after = np.minimum(starts + np.bincount(others_ids, weights=x_others <= length,
+                                                   minlength=num_others).astype(np.int64), ends)
+    others_before = np.maximum(others_after - 1, starts)
+    x_before, x_after = x_others[others_before], x_others[others_after]
+    koef = (length - x_before) / np.where(x_after > x_before, x_after - x_before, 1.0)
+    long_start = radius_others[others_before] + koef * (radius_others[others_after] - radius_others[others_before])
+    self_shorter = (radius[-1], long_start, radius_others[others_after], x_after - length)
+
+    # the other profile is shorter: self is linear between its nodes around the end of the other one
+    others_end = np.where(valid, others_length, 0.0)
+    after = np.minimum(np.searchsorted(x, others_end, side="right"), len(x) - 1)
+    other_shorter = (radius_others[np.maximum(ends, 0)], np.interp(others_end, x, radius),
+                     radius[after], x[after] - others_end)
+
+    is_self_shorter = length < others_length
+    end_radius, long_start, long_end, edge_length = [np.where(is_self_shorter, first, second)
+                                                     for first, second in zip(self_shorter, other_shorter)]
+    step_part = calculate_abs_linear_integrals(long_start, long_end, edge_length)
+    ramp_part = calculate_abs_linear_integrals(long_start - end_radius, long_end, edge_length)
+    correction = 2 * (step_part - ramp_part)
+    res[valid] = np.where(length == others_length, 0.0, correction)[valid]
+    return res
+
+
+def calculate_symmetric_diff_block(x_all: np.ndarray, radius_all: np.ndarray, offsets: np.ndarray,
+                                   row_start: int, row_end: int, col_start: int, col_end: int) -> np.ndarray:
+    # only pairs with column > row are computed, the rest of the block stays NaN
+    block = np.full((row_end - row_start, col_end - col_start), np.nan)
+    for i in range(row_start, row_end):
+        first_col = max(col_start, i + 1)
+        if first_col >= col_end:
+            continue
+        x = x_all[offsets[i]:offsets[i + 1]]
+        radius = radius_all[offsets[i]:offsets[i + 1]]
+        cols_offsets = offsets[first_col:col_end + 1]
+        x_others = x_all[cols_offsets[0]:cols_offsets[-1]]
+        radius_others = radius_all[cols_offsets[0]:cols_offsets[-1]]
+        block[i - row_start, first_col - col_start:] = calculate_symmetric_diff_row(x, radius, x_others,
+                                                                                    radius_others, cols_offsets)
+    return block
+
+
+def calculate_profile_nodes(x: np.ndarray, radius: np.ndarray, grid: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+    # radius of the profile moved by shifts at every grid node, zero outside its own nodes; between grid
+    # nodes it is linear, so past its ends it ramps to zero at the neighbouring node of the other profile
+    # as in unite_shapes. Ends are compared in grid coordinates, where they are exact.
+    inside = (grid >= x[0] + shifts[:, None]) & (grid <= x[-1] + shifts[:, None])
+    return np.where(inside, np.interp(np.clip(grid - shifts[:, None], x[0], x[-1]), x, radius), 0.0)
+
+
+def calculate_shifted_diffs(x_1: np.ndarray, radius_1: np.ndarray, x_2: np.ndarray, radius_2: np.ndarray,
+                            shifts: np.ndarray) -> np.ndarray:
+    # exact symmetric difference for every shift of the second profile along the axis; at zero shift it
+    # equals calculate_symmetric_diff_square
+    shifts = np.asarray(shifts, dtype=float)
+    grid = np.sort(np.concatenate([np.broadcast_to(x_1, (len(shifts), len(x_1))), x_2[None, :] + shifts[:, None]],
+                                  axis=1), axis=1)
+    diff = calculate_profile_nodes(x_1, radius_1, grid, np.zeros(len(shifts))) - \
+        calculate_profile_nodes(x_2, radius_2, grid, shifts)
+    segments = calculate_abs_linear_integrals(diff[:, :-1], diff[:, 1:], np.diff(grid, axis=1))
+    return 2 * segments.sum(axis=1)
+
+
+def flip_profile(x: np.ndarray, radius: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # tail becomes head, as SkeletonWay.fix_head_tail_skeleton_way reverses the profile
+    return x[-1] - x[::-1], radius[::-1].copy()
+
+
+def calculate_coarse_diffs(x_1: np.ndarray, radius_1: np.ndarray, profiles_2: List[Tuple[np.ndarray, np.ndarray]],
+                           step: float) -> Tuple[np.ndarray, np.ndarray]:
+    # Profiles sampled at the centres of cells of size step; the midpoint sums of |r_1 - r_2| for all
+    # shifts k * step, k from -num_2 to num_1, are taken at once over sliding windows of the first profile.
+    num_1 = int(np.ceil(x_1[-1] / step)) + 1
+    num_2 = int(np.ceil(max(x_2[-1] for x_2, _ in profiles_2) / step)) + 1
+    samples_1 = np.interp((np.arange(num_1) + 0.5) * step, x_1, radius_1, left=0.0, right=0.0)
+    samples_2 = np.stack([np.interp((np.arange(num_2) + 0.5) * step, x_2, radius_2, left=0.0, right=0.0)
+                          for x_2, radius_2 in profiles_2])
+    padded_1 = np.concatenate([np.zeros(num_2), samples_1, np.zeros(num_2)])
+    windows = np.lib.stride_tricks.sliding_window_view(padded_1, num_2)
+    overlap = np.abs(windows[None, :, :] - samples_2[:, None, :]).sum(axis=2)
+    # the part of the first profile outside the window differs from zero
+    outside = samples_1.sum() - windows.sum(axis=1)
+    return 2 * step * (overlap + outside[None, :]), (np.arange(len(windows)) - num_2) * step
+
+
+def calculate_aligned_symmetric_diff(x_1: np.ndarray, radius_1: np.ndarray, x_2: np.ndarray, radius_2: np.ndarray,
+                                     max_shift: Optional[float] = None, num_coarse: int = 64,
+                                     num_candidates: int = 4, refine_points: int = 8,
+                                     refine_rounds: int = 3) -> Tuple[float, bool, float]:
+    # Smallest symmetric difference over both orientations of the second profile and its shifts along
+    # the axis. All shifts on a grid of max length / num_coarse are scored on resampled profiles, then
+    # the num_candidates best are refined with the exact distance on finer and finer local grids. Both
+    # orientations at zero shift are always candidates, so the result never exceeds the unaligned distance.
+    # Returns the distance, whether the second profile is flipped and its shift.
+    if refine_rounds < 1 or refine_points < 1:
+        raise ValueError("refine_rounds and refine_points must be at least 1")
+    if len(x_1) == 0 or len(x_2) == 0:
+        return np.nan, False, 0.0
+    profiles_2 = [(x_2, radius_2), flip_profile(x_2, radius_2)]
+    anchored = [calculate_shifted_diffs(x_1, radius_1, x, radius, np.zeros(1))[0] for x, radius in profiles_2]
+    best = (float(min(anchored)), bool(anchored[1] < anchored[0]), 0.0)
+    step = max(x_1[-1], x_2[-1]) / num_coarse
+    if step == 0:
+        return best
+    coarse_diffs, coarse_shifts = calculate_coarse_diffs(x_1, radius_1, profiles_2, step)
+    if max_shift is not None:
+        coarse_diffs[:, np.abs(coarse_shifts) > max_shift + step] = np.inf
+    # candidates are the best local minima, so they do not crowd into one basin
+    padded = np.pad(coarse_diffs, ((0, 0), (1, 1)), constant_values=np.inf)
+    local_minima = (coarse_diffs <= padded[:, :-2]) & (coarse_diffs <= padded[:, 2:]) & np.isfinite(coarse_diffs)
+    candidates = np.argsort(np.where(local_minima, coarse_diffs, np.inf), axis=None)[:num_candidates]
+    candidates = candidates[local_minima.ravel()[candidates]]
+
+    for flipped, shift_id in zip(*np.unravel_index(candidates, coarse_diffs.shape)):
+        x, radius = profiles_2[flipped]
+        shift, half_width = coarse_shifts[shift_id], step
+        for _ in range(refine_rounds):
+            shifts = shift + np.linspace(-half_width, half_width, 2 * refine_points + 1)
+            if max_shift is not None:
+                shifts = np.clip(shifts, -max_shift, max_shift)
+            diffs = calculate_shifted_diffs(x_1, radius_1, x, radius, shifts)
+            shift = shifts[np.argmin(diffs)]
+            half_width /= refine_points
+        if diffs.min() < best[0]:
+            best = (float(diffs.min()), bool(flipped), float(shift))
+    return best
+
+
+def calculate_relative_diff(absolute_diff: np.ndarray, squares_1: np.ndarray, squares_2: np.ndarray) -> np.ndarray:
+    union_square = (squares_1[:, None] + squares_2[None, :] - absolute_diff) / 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return absolute_diff / (union_square + absolute_diff)
+
+
 class ShapeMatcher:
     def __init__(self):
         pass
 
     @staticmethod
+    @instrumented("symmetric_diff_square")
     def calculate_symmetric_diff_square(skeleton_1: SkeletonWay, skeleton_2: SkeletonWay):
         shape_1, shape_2 = skeleton_1.get_straight_skeleton(), skeleton_2.get_straight_skeleton()
         shape_1_unite, shape_2_unite = unite_shapes(shape_1, shape_2)
@@ -118,3 +352,34 @@ class ShapeMatcher:
         res["relative_diff"] = relative_symmetric_diff
         return res
 
+    @staticmethod
+    @instrumented("aligned_symmetric_diff")
+    def calculate_aligned_symmetric_diff(skeleton_1: SkeletonWay, skeleton_2: SkeletonWay,
+                                         max_shift: Optional[float] = None) -> Tuple[float, bool, float]:
+        (x_1, radius_1), (x_2, radius_2) = skeleton_1.get_straight_profile(), skeleton_2.get_straight_profile()
+        return calculate_aligned_symmetric_diff(x_1, radius_1, x_2, radius_2, max_shift)
+
+    def get_aligned_diff_features(self, skeleton_1: SkeletonWay, skeleton_2: SkeletonWay,
+                                  max_shift: Optional[float] = None):
+        res = dict()
+        symmetric_diff, flipped, shift = self.calculate_aligned_symmetric_diff(skeleton_1, skeleton_2, max_shift)
+        res["absolute_diff"] = symmetric_diff
+        skeleton_1_square, skeleton_2_square = skeleton_1.calculate_square(), skeleton_2.calculate_square()
+        union_square = (skeleton_1_square + skeleton_2_square - symmetric_diff) / 2
+        res["relative_diff"] = symmetric_diff / (union_square + symmetric_diff)
+        res["flipped"] = flipped
+        res["shift"] = shift
+        return res
+
+    @staticmethod
+    def pairwise_matrix(skeletons: List[SkeletonWay]) -> Tuple[np.ndarray, np.ndarray]:
+        num_skeletons = len(skeletons)
+        x_all, radius_all, offsets = pack_profiles(skeletons)
+        squares = np.array([skeleton.calculate_square() for skeleton in skeletons], dtype=float)
+        absolute_diff = calculate_symmetric_diff_block(x_all, radius_all, offsets, 0, num_skeletons, 0, num_skeletons)
+        upper = np.triu_indices(num_skeletons, 1)
+        absolute_diff[upper[1], upper[0]] = absolute_diff[upper]
+        diagonal = np.arange(num_skeletons)
+        absolute_diff[diagonal, diagonal] = np.where(np.diff(offsets) > 0, 0.0, np.nan)
+        relative_diff = calculate_relative_diff(absolute_diff, squares, squares)
+        return absolute_diff, relative_diff
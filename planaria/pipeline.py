@@ -0,0 +1,136 @@
+import os
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from skimage import io, img_as_ubyte
+from skimage.morphology import medial_axis
+from planaria.config import PLANARIA_PHOTO_DIR_PATH
+from planaria.instrumentation import InstrumentedTask, instrumented, stage, unwrap
+from planaria.preprocessing.skeleton_way import SkeletonWay
+from planaria.preprocessing.skeleton_structure import Skeleton
+from planaria.segmentation.segmentation import find_planaria, find_planaria_fast
+
+# medial_axis breaks ties randomly unless seeded; scikit-image 0.18 seeds it itself and has no such argument
+MEDIAL_AXIS_SEED = {name: 0 for name in ["rng", "random_state"] if name in inspect.signature(medial_axis).parameters}
+
+
+def mask_to_skeleton(mask: np.ndarray) -> Skeleton:
+    # medial axis pixels become nodes (x is the column, y the row) with the distance to the background
+    # as radius; neighbouring pixels are joined, diagonals only where no 4-connected path exists
+    with stage("medial_axis"):
+        skeleton_mask, distance = medial_axis(mask > 0, return_distance=True, **MEDIAL_AXIS_SEED)
+    rows, cols = np.nonzero(skeleton_mask)
+    index = np.full((skeleton_mask.shape[0] + 2, skeleton_mask.shape[1] + 2), -1, dtype=np.int64)
+    index[rows + 1, cols + 1] = np.arange(len(rows))
+    rows, cols = rows + 1, cols + 1
+    first_nodes, second_nodes = [], []
+    for row_shift, col_shift in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        neighbours = index[rows + row_shift, cols + col_shift]
+        connected = neighbours >= 0
+        if row_shift and col_shift:
+            connected &= (index[rows, cols + col_shift] < 0) & (index[rows + row_shift, cols] < 0)
+        first_nodes.append(index[rows, cols][connected])
+        second_nodes.append(neighbours[connected])
+    points = np.stack([cols - 1, rows - 1], axis=1).astype(float)
+    return Skeleton.from_arrays(np.arange(len(points)), points, distance[rows - 1, cols - 1],
+                                np.concatenate(first_nodes), np.concatenate(second_nodes))
+
+
+def mask_to_skeleton_way(mask: np.ndarray, min_length: float = 0.0, radius_factor: float = 1.0) -> SkeletonWay:
+    return mask_to_skeleton(mask).to_skeleton_way(min_length=min_length, radius_factor=radius_factor)
+
+
+@instrumented("photo_features")
+def photo_features(photo_path: str, downscale: Optional[int] = None, min_length: float = 0.0,
+                   radius_factor: float = 1.0, segmentation_path: Optional[str] = None,
+                   skeleton_way_path: Optional[str] = None) -> Dict:
+    # photo -> mask -> skeleton way -> features in memory; the mask and the skeleton way are written only
+    # when their paths are given
+    with stage("decode_image"):
+        image = io.imread(photo_path)
+    mask = find_planaria(image) if downscale is None else find_planaria_fast(image, downscale=downscale)
+    if segmentation_path is not None:
+        with stage("save_segmentation"):
+            io.imsave(segmentation_path, img_as_ubyte(1 - (mask > 0).astype(float)), check_contrast=False)
+    skeleton_way = mask_to_skeleton_way(mask, min_length=min_length, radius_factor=radius_factor)
+    if skeleton_way_path is not None:
+        skeleton_way.save(skeleton_way_path)
+    return skeleton_way.get_features()
+
+
+def _photo_features_task(task) -> Tuple[str, Optional[Dict], Optional[str]]:
+    photo_path, kwargs = task
+    try:
+        return photo_path, photo_features(photo_path, **kwargs), None
+    except Exception as e:
+        return photo_path, None, "{}: {}".format(type(e).__name__, e)
+
+
+def photo_features_task(photo_path: str, downscale: Optional[int] = None, min_length: float = 0.0,
+                        radius_factor: float = 1.0, segmentation_dir: Optional[str] = None,
+                        skeleton_dir: Optional[str] = None, skeleton_way_ending: str = "_skeleton_extra.txt"):
+    kwargs = {"downscale": downscale, "min_length": min_length, "radius_factor": radius_factor}
+    if segmentation_dir is not None:
+        os.makedirs(segmentation_dir, exist_ok=True)
+        kwargs["segmentation_path"] = os.path.join(segmentation_dir, os.path.basename(photo_path))
+    if skeleton_dir is not None:
+        os.makedirs(skeleton_dir, exist_ok=True)
+        sample_name = os.path.splitext(os.path.basename(photo_path))[0]
+        kwargs["skeleton_way_path"] = os.path.join(skeleton_dir, sample_name + skeleton_way_ending)
+    return photo_path, kwargs
+
+
+def run_photo_features_tasks(tasks: List[Tuple[str, Dict]], class_labels: Optional[List[int]] = None,
+                             n_jobs: int = 1) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    # rows follow the FeaturePreprocesser layout; photos that failed are left out and returned with their errors
+    if n_jobs == 1 or len(tasks) <= 1:
+        results = [_photo_features_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = [unwrap(task_result)
+                       for task_result in executor.map(InstrumentedTask(_photo_features_task), tasks, chunksize=4)]
+
+    res_dict = {"sample": [], "class_label": []}
+    failed = dict()
+    for i, (photo_path, features, error) in enumerate(results):
+        if error is not None:
+            failed[photo_path] = error
+            continue
+        res_dict["sample"].append(os.path.splitext(os.path.basename(photo_path))[0])
+        res_dict["class_label"].append(class_labels[i] if class_labels is not None else None)
+        for key, feature in features.items():
+            res_dict.setdefault(key, []).append(feature)
+    return pd.DataFrame(res_dict), failed
+
+
+def photos_features(photo_paths: List[str], class_labels: Optional[List[int]] = None, n_jobs: int = 1,
+                    downscale: Optional[int] = None, min_length: float = 0.0, radius_factor: float = 1.0,
+                    segmentation_dir: Optional[str] = None,
+                    skeleton_dir: Optional[str] = None) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    tasks = [photo_features_task(photo_path, downscale, min_length, radius_factor, segmentation_dir, skeleton_dir)
+             for photo_path in photo_paths]
+    return run_photo_features_tasks(tasks, class_labels, n_jobs)
+
+
+def all_photos_features(all_photos_dir: str = PLANARIA_PHOTO_DIR_PATH, n_jobs: int = 1,
+                        downscale: Optional[int] = None, min_length: float = 0.0, radius_factor: float = 1.0,
+                        segmentation_dir: Optional[str] = None,
+                        skeleton_dir: Optional[str] = None) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    # photos are laid out as for segment_all_photos, the class label comes from the "planaria N" directory
+    # and the artifacts of every class go to a subdirectory of the same name
+    tasks, class_labels = [], []
+    for directory in sorted(os.listdir(all_photos_dir)):
+        photo_directory = os.path.join(all_photos_dir, directory)
+        if not os.path.isdir(photo_directory):
+            continue
+        class_segmentation_dir = os.path.join(segmentation_dir, directory) if segmentation_dir is not None else None
+        class_skeleton_dir = os.path.join(skeleton_dir, directory) if skeleton_dir is not None else None
+        for photo_name in sorted(os.listdir(photo_directory)):
+            if not photo_name.endswith('bmp'):
+                continue
+            tasks.append(photo_features_task(os.path.join(photo_directory, photo_name), downscale, min_length,
+                                             radius_factor, class_segmentation_dir, class_skeleton_dir))
+            class_labels.append(int(directory.split(' ')[-1]))
+    return run_photo_features_tasks(tasks, class_labels, n_jobs)
@@ -1,3 +1,19 @@
-from . import draw_data
+import importlib
 from .preprocessing import Preprocesser, ShapePreprocesser, FeaturePreprocesser
 from .skeleton_way import SkeletonWay
+from .skeleton_archive import SkeletonArchive, write_skeleton_archive
+from .skeleton_collection import SkeletonCollection
+from .feature_store import FeatureStore
+
+# drawing modules pull in PIL and matplotlib, so they are imported on first access
+_LAZY_SUBMODULES = ["draw_data", "render", "batch_render"]
+
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + _LAZY_SUBMODULES)
@@ -0,0 +1,129 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from PIL import Image
+from planaria.instrumentation import InstrumentedTask, unwrap
+from .read_data import parse_file_arrays
+from .render import render_edges, render_voronoi, render_skeleton, render_skeleton_way, tile_images
+
+DEFAULT_DIAGRAM_ENDINGS = {
+    "voronoi": "_voronoi.txt",
+    "skeleton": "_skeleton.txt",
+    "skeleton_cut": "_skeleton_cut.txt",
+    "skeleton_extra": "_skeleton_extra.txt",
+}
+
+
+def find_diagram_samples(diagram_dir: str,
+                         endings: Optional[Dict[str, str]] = None) -> List[Tuple[str, Dict[str, str]]]:
+    endings = endings or DEFAULT_DIAGRAM_ENDINGS
+    # longest ending first, so that an ending which is a suffix of another one does not take its files
+    ordered_endings = sorted(endings.items(), key=lambda item: -len(item[1]))
+    samples = defaultdict(dict)
+    for path, _, names in os.walk(diagram_dir):
+        for name in names:
+            for view, ending in ordered_endings:
+                if name.endswith(ending):
+                    sample_name = os.path.relpath(os.path.join(path, name[:-len(ending)]), diagram_dir)
+                    samples[sample_name][view] = os.path.join(path, name)
+                    break
+    return sorted(samples.items())
+
+
+def parse_sample_diagrams(sample_files: Dict[str, str]) -> Dict[str, tuple]:
+    parsed = dict()
+    if "voronoi" in sample_files:
+        parsed["voronoi"] = parse_file_arrays(sample_files["voronoi"], diagram_type="voronoi", as_dicts=True)
+    for view in ("skeleton", "skeleton_cut"):
+        if view in sample_files:
+            parsed[view] = parse_file_arrays(sample_files[view], diagram_type="skeleton", as_dicts=True)
+    if "skeleton_extra" in sample_files:
+        parsed["skeleton_extra"] = parse_file_arrays(sample_files["skeleton_extra"], diagram_type="skeleton_way",
+                                                     as_dicts=True)
+    return parsed
+
+
+def render_sample_views(sample_files: Dict[str, str], image_size: tuple = (900, 900),
+                        draw_circles: bool = False) -> List[Image.Image]:
+    # every file is parsed once and its geometry is shared by all views that need it
+    parsed = parse_sample_diagrams(sample_files)
+    views = []
+    if "voronoi" in parsed:
+        views.append(render_voronoi(*parsed["voronoi"], image_size=image_size))
+    if "skeleton" in parsed:
+        views.append(render_skeleton(*parsed["skeleton"], image_size=image_size, draw_circles=draw_circles))
+    if "skeleton_cut" in parsed:
+        views.append(render_skeleton(*parsed["skeleton_cut"], image_size=image_size, draw_circles=draw_circles))
+    if "skeleton_extra" in parsed:
+        _, _, extra_edges, skeleton_way = parsed["skeleton_extra"]
+        if "skeleton_cut" in parsed:
+            views.append(render_edges(render_skeleton(*parsed["skeleton_cut"], image_size=image_size), extra_edges))
+        # without the skeleton file the way is drawn on a blank canvas
+        polygons = parsed["skeleton"][0] if "skeleton" in parsed else []
+        views.append(render_skeleton_way(polygons, skeleton_way, image_size=image_size, draw_circles=draw_circles))
+    return views
+
+
+def render_sample(sample: Tuple[str, Dict[str, str]], output_dir: str, image_size: tuple = (900, 900),
+                  draw_circles: bool = False) -> Optional[str]:
+    sample_name, sample_files = sample
+    views = render_sample_views(sample_files, image_size, draw_circles)
+    if not views:
+        print("nothing to render for {}".format(sample_name))
+        return None
+    output_path = os.path.join(output_dir, sample_name + ".png")
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tile_images(views, columns=len(views)).save(output_path)
+    return output_path
+
+
+def render_contact_sheet(samples: List[Tuple[str, Dict[str, str]]], output_path: str,
+                         image_size: tuple = (900, 900), thumbnail_size: tuple = (300, 300),
+                         draw_circles: bool = False) -> Optional[str]:
+    rows = []
+    for sample_name, sample_files in samples:
+        views = render_sample_views(sample_files, image_size, draw_circles)
+        if not views:
+            print("nothing to render for {}".format(sample_name))
+            continue
+        rows.append(tile_images(views, columns=len(views), tile_size=thumbnail_size))
+    if not rows:
+        return None
+    width = max(row.size[0] for row in rows)
+    sheet = Image.new("RGB", (width, sum(row.size[1] for row in rows)), (255, 255, 255))
+    top = 0
+    for row in rows:
+        sheet.paste(row, (0, top))
+        top += row.size[1]
+    sheet.save(output_path)
+    return output_path
+
+
+def _render_task(task) -> Optional[str]:
+    kind, payload, output_path, kwargs = task
+    if kind == "sample":
+        return render_sample(payload, output_path, **kwargs)
+    return render_contact_sheet(payload, output_path, **kwargs)
+
+
+def render_diagrams(samples: List[Tuple[str, Dict[str, str]]], output_dir: str, n_jobs: int = 1,
+                    samples_per_sheet: Optional[int] = None, image_size: tuple = (900, 900),
+                    thumbnail_size: tuple = (300, 300), draw_circles: bool = False) -> List[str]:
+    os.makedirs(output_dir, exist_ok=True)
+    if samples_per_sheet is None:
+        kwargs = {"image_size": image_size, "draw_circles": draw_circles}
+        tasks = [("sample", sample, output_dir, kwargs) for sample in samples]
+    else:
+        kwargs = {"image_size": image_size, "thumbnail_size": thumbnail_size, "draw_circles": draw_circles}
+        tasks = [("sheet", samples[i:i + samples_per_sheet],
+                  os.path.join(output_dir, "contact_sheet_{:04d}.png".format(i // samples_per_sheet)), kwargs)
+                 for i in range(0, len(samples), samples_per_sheet)]
+    if n_jobs == 1 or len(tasks) <= 1:
+        output_paths = [_render_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            output_paths = [unwrap(task_result)
+                            for task_result in executor.map(InstrumentedTask(_render_task), tasks)]
+    # samples with nothing to draw are reported and left out
+    return [output_path for output_path in output_paths if output_path is not None]
@@ -0,0 +1,51 @@
+import os
+import hashlib
+from typing import Dict, List, Set, Tuple
+import numpy as np
+
+# bump when SkeletonWay.get_features changes, so stored features are recomputed
+FEATURE_STORE_VERSION = 1
+
+
+class FeatureStore:
+    # Features of every skeleton file are stored in one .npz, keyed by the file path relative to the
+    # skeleton directory plus a signature: (size, mtime_ns) or, with validation="hash", the SHA-1 of the file.
+    def __init__(self, store_path: str, validation: str = "mtime"):
+        assert validation in ["mtime", "hash"]
+        self.store_path = store_path
+        self.validation = validation
+        self.hits = 0
+        self.misses = 0
+        self.removed = 0
+
+    def signature(self, path: str) -> str:
+        if self.validation == "hash":
+            digest = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            return digest.hexdigest()
+        stat = os.stat(path)
+        return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+    def load(self) -> Tuple[List[str], List[str], Dict[str, np.ndarray], Set[str]]:
+        if not os.path.exists(self.store_path):
+            return [], [], dict(), set()
+        with np.load(self.store_path, allow_pickle=False) as store:
+            if int(store["version"]) != FEATURE_STORE_VERSION or str(store["validation"]) != self.validation:
+                return [], [], dict(), set()
+            keys = store["keys"].tolist()
+            signatures = store["signatures"].tolist()
+            columns = {name: store["feature_" + name] for name in store["feature_names"].tolist()}
+            integer_features = set(store["integer_features"].tolist())
+        return keys, signatures, columns, integer_features
+
+    def save(self, keys: List[str], signatures: List[str], columns: Dict[str, np.ndarray],
+             integer_features: Set[str]) -> None:
+        arrays = {"feature_" + name: np.asarray(column, dtype=float) for name, column in columns.items()}
+        tmp_path = self.store_path + ".tmp.npz"
+        np.savez(tmp_path, version=np.array(FEATURE_STORE_VERSION), validation=np.array(self.validation),
+                 keys=np.array(keys, dtype=str), signatures=np.array(signatures, dtype=str),
+                 feature_names=np.array(list(columns), dtype=str),
+                 integer_features=np.array(sorted(integer_features), dtype=str), **arrays)
+        os.replace(tmp_path, self.store_path)
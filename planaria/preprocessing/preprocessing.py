@@ -1,74 +1,224 @@
 import os
+from typing import Optional
 from .skeleton_way import SkeletonWay
+from .skeleton_archive import SkeletonArchive, write_skeleton_archive
+from .skeleton_collection import SkeletonCollection
+from .feature_store import FeatureStore
+from planaria.instrumentation import InstrumentedTask, unwrap
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import math
 
 
+def calculate_features_columns(skeletons):
+    columns = defaultdict(list)
+    for skeleton_way in skeletons:
+        for key, feature in skeleton_way.get_features().items():
+            columns[key].append(feature)
+    return {key: np.array(values) for key, values in columns.items()}
+
+
+def calculate_files_features_columns(skeleton_files):
+    return calculate_features_columns(SkeletonWay(skeleton_file) for skeleton_file in skeleton_files)
+
+
+def calculate_archive_features_columns(archive_path, start, end):
+    archive = SkeletonArchive(archive_path)
+    return calculate_features_columns(archive.get_skeleton(i) for i in range(start, end))
+
+
+def run_features_batches(batch_function, batch_args, n_jobs: Optional[int] = None):
+    batches_columns = []
+    if len(batch_args[0]) > 0:
+        # map keeps batch order, so rows come out in the same order as in the serial run
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            batches_columns = [unwrap(task_result)
+                               for task_result in executor.map(InstrumentedTask(batch_function), *batch_args)]
+    res = dict()
+    if batches_columns:
+        for key in batches_columns[0]:
+            res[key] = np.concatenate([columns[key] for columns in batches_columns])
+    return res
+
+
+def calculate_files_features(skeleton_files, n_jobs: int = 1, batch_size: int = 256):
+    if n_jobs == 1:
+        return calculate_files_features_columns(skeleton_files)
+    batches = [skeleton_files[i:i + batch_size] for i in range(0, len(skeleton_files), batch_size)]
+    return run_features_batches(calculate_files_features_columns, (batches,), n_jobs)
+
+
 class Preprocesser:
-    def __init__(self, skeleton_dir: str, skeleton_way_ending: str = "_skeleton_extra.txt"):
+    def __init__(self, skeleton_dir: str, skeleton_way_ending: str = "_skeleton_extra.txt",
+                 archive_path: Optional[str] = None):
         self._skeleton_dir = skeleton_dir
         self._skeleton_way_ending = skeleton_way_ending
+        self._archive_path = archive_path
 
     @staticmethod
-    def read_skeletons_dir(dir_name, skeleton_way_ending="_skeleton_extra.txt"):
+    def list_skeletons_dir(dir_name, skeleton_way_ending="_skeleton_extra.txt"):
         class_label = int(dir_name.split(' ')[-1])
-        skeletons_dir = []
-        sample_names = []
         skeleton_files = os.listdir(dir_name)
         skeleton_files = [os.path.join(dir_name, x) for x in skeleton_files
                           if x.endswith(skeleton_way_ending)]
-        for skeleton_file in skeleton_files:
-            sample_name = os.path.basename(skeleton_file).rstrip(skeleton_way_ending)
-            sample_names.append(sample_name)
-            skeleton_way = SkeletonWay(skeleton_file)
-            skeletons_dir.append(skeleton_way)
-        class_labels_dir = [class_label] * len(skeletons_dir)
+        sample_names = [os.path.basename(x).rstrip(skeleton_way_ending) for x in skeleton_files]
+        class_labels_dir = [class_label] * len(skeleton_files)
+        return skeleton_files, class_labels_dir, sample_names
+
+    def iter_skeleton_files(self):
+        for directory in os.listdir(self._skeleton_dir):
+            planaria_directory = os.path.join(self._skeleton_dir, directory)
+            if not os.path.isdir(planaria_directory):
+                continue
+            skeleton_files, class_labels_dir, sample_names = self.list_skeletons_dir(planaria_directory,
+                                                                                     self._skeleton_way_ending)
+            yield from zip(skeleton_files, class_labels_dir, sample_names)
+
+    def list_skeletons_all(self):
+        skeleton_files_all = []
+        class_labels_all = []
+        sample_names_all = []
+        for skeleton_file, class_label, sample_name in self.iter_skeleton_files():
+            skeleton_files_all.append(skeleton_file)
+            class_labels_all.append(class_label)
+            sample_names_all.append(sample_name)
+        return skeleton_files_all, class_labels_all, sample_names_all
+
+    @staticmethod
+    def read_skeletons_dir(dir_name, skeleton_way_ending="_skeleton_extra.txt"):
+        skeleton_files, class_labels_dir, sample_names = Preprocesser.list_skeletons_dir(dir_name,
+                                                                                         skeleton_way_ending)
+        skeletons_dir = [SkeletonWay(skeleton_file) for skeleton_file in skeleton_files]
         return skeletons_dir, class_labels_dir, sample_names
 
+    def pack_archive(self, archive_path: str) -> None:
+        skeleton_files_all, class_labels_all, sample_names_all = self.list_skeletons_all()
+        write_skeleton_archive(archive_path, skeleton_files_all, class_labels_all, sample_names_all)
+
+    def iter_skeletons(self, len_threshold: Optional[float] = None):
+        if self._archive_path is not None:
+            archive = SkeletonArchive(self._archive_path)
+            skeletons = ((archive.get_sample_name(i), int(archive.class_labels[i]), archive.get_skeleton(i))
+                         for i in range(len(archive)))
+        else:
+            skeletons = ((sample_name, class_label, SkeletonWay(skeleton_file))
+                         for skeleton_file, class_label, sample_name in self.iter_skeleton_files())
+        for sample_name, class_label, skeleton_way in skeletons:
+            if len_threshold is not None:
+                skeleton_len = skeleton_way.calculate_length()
+                if math.isnan(skeleton_len) or (skeleton_len >= len_threshold):
+                    continue
+            yield sample_name, class_label, skeleton_way
+
+    def read_skeleton_collection(self, len_threshold: Optional[float] = None) -> SkeletonCollection:
+        if self._archive_path is not None:
+            collection = SkeletonCollection.from_archive(SkeletonArchive(self._archive_path))
+        else:
+            collection = SkeletonCollection.from_skeleton_files(*self.list_skeletons_all())
+        if len_threshold is not None:
+            collection = collection.filter_length(len_threshold)
+        return collection
+
     def read_skeletons_all(self):
         skeletons_all = []
         class_labels_all = []
         sample_names_all = []
-        for directory in os.listdir(self._skeleton_dir):
-            planaria_directory = os.path.join(self._skeleton_dir, directory)
-            if not os.path.isdir(planaria_directory):
-                continue
-            skeletons_dir, class_labels_dir, sample_names = self.read_skeletons_dir(planaria_directory,
-                                                                                    self._skeleton_way_ending)
-            skeletons_all.extend(skeletons_dir)
-            class_labels_all.extend(class_labels_dir)
-            sample_names_all.extend(sample_names)
+        for sample_name, class_label, skeleton_way in self.iter_skeletons():
+            skeletons_all.append(skeleton_way)
+            class_labels_all.append(class_label)
+            sample_names_all.append(sample_name)
         return skeletons_all, class_labels_all, sample_names_all
 
 
 class FeaturePreprocesser(Preprocesser):
-    def __init__(self, skeleton_dir: str, skeleton_way_ending: str = "_skeleton_extra.txt"):
-        super().__init__(skeleton_dir, skeleton_way_ending)
+    def __init__(self, skeleton_dir: str, skeleton_way_ending: str = "_skeleton_extra.txt",
+                 archive_path: Optional[str] = None):
+        super().__init__(skeleton_dir, skeleton_way_ending, archive_path)
 
-    def preprocess_all(self) -> pd.DataFrame:
-        skeletons_all, class_labels_all, sample_names_all = self.read_skeletons_all()
+    def preprocess_all(self, n_jobs: int = 1, batch_size: int = 256,
+                       feature_store: Optional[FeatureStore] = None) -> pd.DataFrame:
+        if feature_store is not None:
+            return self.preprocess_all_cached(feature_store, n_jobs, batch_size)
+        if n_jobs != 1:
+            return self.preprocess_all_parallel(n_jobs, batch_size)
         res_dict = defaultdict(list)
-        res_dict["sample"] = sample_names_all
-        res_dict["class_label"] = class_labels_all
-        for skeleton_way in skeletons_all:
+        res_dict["sample"] = []
+        res_dict["class_label"] = []
+        for sample_name, class_label, skeleton_way in self.iter_skeletons():
+            res_dict["sample"].append(sample_name)
+            res_dict["class_label"].append(class_label)
             skeleton_features = skeleton_way.get_features()
             for key, feature in skeleton_features.items():
                 res_dict[key].append(feature)
         return pd.DataFrame(res_dict)
 
+    def preprocess_all_parallel(self, n_jobs: Optional[int] = None, batch_size: int = 256) -> pd.DataFrame:
+        res_dict = dict()
+        if self._archive_path is not None:
+            archive = SkeletonArchive(self._archive_path)
+            res_dict["sample"] = archive.get_sample_names()
+            res_dict["class_label"] = archive.class_labels.tolist()
+            bounds = list(range(0, len(archive), batch_size)) + [len(archive)]
+            batch_args = ([self._archive_path] * (len(bounds) - 1), bounds[:-1], bounds[1:])
+            res_dict.update(run_features_batches(calculate_archive_features_columns, batch_args, n_jobs))
+        else:
+            skeleton_files_all, class_labels_all, sample_names_all = self.list_skeletons_all()
+            res_dict["sample"] = sample_names_all
+            res_dict["class_label"] = class_labels_all
+            res_dict.update(calculate_files_features(skeleton_files_all, n_jobs, batch_size))
+        return pd.DataFrame(res_dict)
+
+    def preprocess_all_cached(self, feature_store: FeatureStore, n_jobs: int = 1,
+                              batch_size: int = 256) -> pd.DataFrame:
+        assert self._archive_path is None
+        skeleton_files_all, class_labels_all, sample_names_all = self.list_skeletons_all()
+        keys = [os.path.relpath(skeleton_file, self._skeleton_dir) for skeleton_file in skeleton_files_all]
+        signatures = [feature_store.signature(skeleton_file) for skeleton_file in skeleton_files_all]
+        stored_keys, stored_signatures, stored_columns, integer_features = feature_store.load()
+        stored_index = {key: (i, signature) for i, (key, signature) in enumerate(zip(stored_keys, stored_signatures))}
+
+        stored_rows = np.full(len(keys), -1, dtype=np.int64)
+        for i, (key, signature) in enumerate(zip(keys, signatures)):
+            stored_row, stored_signature = stored_index.get(key, (-1, None))
+            if stored_signature == signature:
+                stored_rows[i] = stored_row
+        hits = stored_rows >= 0
+        missed_files = [skeleton_file for skeleton_file, hit in zip(skeleton_files_all, hits) if not hit]
+        missed_columns = calculate_files_features(missed_files, n_jobs, batch_size)
+        integer_features |= {key for key, column in missed_columns.items() if column.dtype.kind in "iu"}
+
+        columns = dict()
+        for key in (missed_columns if missed_columns else stored_columns):
+            column = np.empty(len(keys))
+            if hits.any():
+                column[hits] = stored_columns[key][stored_rows[hits]]
+            column[~hits] = missed_columns.get(key, np.empty(0))
+            columns[key] = column
+        feature_store.hits = int(hits.sum())
+        feature_store.misses = len(missed_files)
+        feature_store.removed = len(set(stored_keys) - set(keys))
+        feature_store.save(keys, signatures, columns, integer_features)
+
+        res_dict = {"sample": sample_names_all, "class_label": class_labels_all}
+        for key, column in columns.items():
+            # columns that hold ints when defined come out as ints, as in the uncached run
+            if key in integer_features and not np.isnan(column).any():
+                column = column.astype(np.int64)
+            res_dict[key] = column
+        return pd.DataFrame(res_dict)
+
 
 class ShapePreprocesser(Preprocesser):
-    def __init__(self, skeleton_dir: str, skeleton_way_ending: str = "_skeleton_extra.txt"):
-        super().__init__(skeleton_dir, skeleton_way_ending)
+    def __init__(self, skeleton_dir: str, skeleton_way_ending: str = "_skeleton_extra.txt",
+                 archive_path: Optional[str] = None):
+        super().__init__(skeleton_dir, skeleton_way_ending, archive_path)
 
     def preprocess_all(self, len_threshold: int = 900):
-        skeletons_all, class_labels_all, sample_names_all = self.read_skeletons_all()
         skeletons_res, class_labels_res, sample_names_res = [], [], []
-        for skeleton, class_label, name in zip(skeletons_all, class_labels_all, sample_names_all):
-            skeleton_len = skeleton.calculate_length()
-            if (not math.isnan(skeleton_len)) and (skeleton_len < len_threshold):
-                skeletons_res.append(skeleton)
-                class_labels_res.append(class_label)
-                sample_names_res.append(name)
+        for name, class_label, skeleton in self.iter_skeletons(len_threshold=len_threshold):
+            skeletons_res.append(skeleton)
+            class_labels_res.append(class_label)
+            sample_names_res.append(name)
         return skeletons_res, class_labels_res, sample_names_res
@@ -1,3 +1,7 @@
+import numpy as np
+from planaria.instrumentation import instrumented
+
+
 def parse_polygons(polygons_raw: str, point_sep: str = "\n", polygon_sep: str = "\n\n"):
     polygons = polygons_raw.split(polygon_sep)
     assert polygons[0] == "POLYGONS"
@@ -113,6 +117,7 @@ def parse_file_extra_skeleton(skeleton_raw: str, total_sep: str = "\n\n\n\n"):
     return count_terminals, parsed_nodes, parsed_edges, skeleton_way
 
 
+@instrumented("parse_file")
 def parse_file(path_to_file: str, diagram_type: str, total_sep: str = "\n\n\n\n"):
     assert diagram_type in ["voronoi", "skeleton", "skeleton_structure", "skeleton_way"]
     with open(path_to_file, "r") as f:
@@ -125,3 +130,139 @@ def parse_file(path_to_file: str, diagram_type: str, total_sep: str = "\n\n\n\n"
         return parse_file_skeleton_structure(file_raw, total_sep)
     else:
         return parse_file_extra_skeleton(file_raw, total_sep)
+
+
+def _section_lines(section_raw: str, header: str = None, line_sep: str = '\n'):
+    lines = section_raw.split(line_sep)
+    if header is not None:
+        assert lines[0] == header
+    return [line for line in lines[1:] if line != ""]
+
+
+def parse_polygons_arrays(polygons_raw: str, point_sep: str = "\n", polygon_sep: str = "\n\n"):
+    header = "POLYGONS"
+    assert polygons_raw.startswith(header)
+    body = polygons_raw[len(header) + len(polygon_sep):]
+    if len(polygons_raw) == len(header) or body == "":
+        return {"points": np.empty((0, 2)), "offsets": np.zeros(1, dtype=np.int64)}
+    counts = [polygon.count(point_sep) + 1 for polygon in body.split(polygon_sep)]
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    points = np.array(body.split(), dtype=float).reshape(-1, 2)
+    assert len(points) == offsets[-1]
+    return {"points": points, "offsets": offsets}
+
+
+def parse_edges_arrays(edges_raw: str, edges_sep: str = '\n', radius_sep: str = '\t'):
+    lines = _section_lines(edges_raw, "EDGES", edges_sep)
+    if not lines:
+        return {"first_points": np.empty((0, 2)), "second_points": np.empty((0, 2)),
+                "virtual_points": np.empty((0, 2)), "has_virtual": np.empty(0, dtype=bool),
+                "radii": np.empty(0), "radii_offsets": np.zeros(1, dtype=np.int64)}
+    coords_raw, radii_raw = zip(*(line.split(radius_sep) for line in lines))
+    coords_counts = np.fromiter((coords.count(' ') + 1 for coords in coords_raw), dtype=np.int64, count=len(lines))
+    assert np.isin(coords_counts, [4, 6]).all()
+    coords = np.array(' '.join(coords_raw).split(), dtype=float)
+    coords_offsets = np.concatenate([[0], np.cumsum(coords_counts)[:-1]])
+    first_points = np.stack([coords[coords_offsets], coords[coords_offsets + 1]], axis=1)
+    second_points = np.stack([coords[coords_offsets + 2], coords[coords_offsets + 3]], axis=1)
+    has_virtual = coords_counts == 6
+    virtual_points = np.full((len(lines), 2), np.nan)
+    virtual_offsets = coords_offsets[has_virtual]
+    virtual_points[has_virtual] = np.stack([coords[virtual_offsets + 4], coords[virtual_offsets + 5]], axis=1)
+
+    radii_counts = np.fromiter((radii.count(' ') + 1 for radii in radii_raw), dtype=np.int64, count=len(lines))
+    radii_offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    radii_offsets[1:] = np.cumsum(radii_counts)
+    radii = np.array(' '.join(radii_raw).split(), dtype=float)
+    return {"first_points": first_points, "second_points": second_points,
+            "virtual_points": virtual_points, "has_virtual": has_virtual,
+            "radii": radii, "radii_offsets": radii_offsets}
+
+
+def parse_structure_edges_arrays(edges_raw: str, edges_sep: str = '\n'):
+    lines = _section_lines(edges_raw, "EDGES", edges_sep)
+    nodes = np.array(' '.join(lines).split(), dtype=np.int64).reshape(-1, 2)
+    return {"first_nodes": nodes[:, 0], "second_nodes": nodes[:, 1]}
+
+
+def parse_nodes_arrays(nodes_raw: str, nodes_sep: str = '\n', radius_sep: str = '\t'):
+    lines = _section_lines(nodes_raw, None, nodes_sep)
+    values = np.array(' '.join(lines).replace(radius_sep, ' ').split(), dtype=float).reshape(-1, 3)
+    assert len(values) == len(lines)
+    return {"points": values[:, :2], "radius": values[:, 2]}
+
+
+def parse_structure_nodes_arrays(nodes_raw: str, nodes_sep: str = '\n', radius_sep: str = '\t'):
+    lines = _section_lines(nodes_raw, None, nodes_sep)
+    tokens = np.array(' '.join(lines).replace(radius_sep, ' ').split()).reshape(-1, 4)
+    assert len(tokens) == len(lines)
+    values = tokens[:, 1:].astype(float)
+    return {"ids": tokens[:, 0].astype(np.int64), "points": values[:, :2], "radius": values[:, 2]}
+
+
+def polygons_arrays_to_dicts(polygons):
+    points = polygons["points"].tolist()
+    offsets = polygons["offsets"].tolist()
+    return [[tuple(point) for point in points[start:end]] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def edges_arrays_to_dicts(edges):
+    first_points, second_points = edges["first_points"].tolist(), edges["second_points"].tolist()
+    virtual_points, has_virtual = edges["virtual_points"].tolist(), edges["has_virtual"].tolist()
+    radii, radii_offsets = edges["radii"].tolist(), edges["radii_offsets"].tolist()
+    parsed_edges = []
+    for i in range(len(first_points)):
+        parsed_edge = {"first_point": tuple(first_points[i]), "second_point": tuple(second_points[i])}
+        if has_virtual[i]:
+            parsed_edge["virtual_point"] = tuple(virtual_points[i])
+        parsed_edge["radii"] = tuple(radii[radii_offsets[i]:radii_offsets[i + 1]])
+        parsed_edges.append(parsed_edge)
+    return parsed_edges
+
+
+def structure_edges_arrays_to_dicts(edges):
+    return [{"first_node": first_node, "second_node": second_node}
+            for first_node, second_node in zip(edges["first_nodes"].tolist(), edges["second_nodes"].tolist())]
+
+
+def nodes_arrays_to_dicts(nodes):
+    points, radii = nodes["points"].tolist(), nodes["radius"].tolist()
+    if "ids" in nodes:
+        return [{"id": node_id, "point": tuple(point), "radius": radius}
+                for node_id, point, radius in zip(nodes["ids"].tolist(), points, radii)]
+    return [{"point": tuple(point), "radius": radius} for point, radius in zip(points, radii)]
+
+
+@instrumented("parse_file_arrays")
+def parse_file_arrays(path_to_file: str, diagram_type: str, total_sep: str = "\n\n\n\n", as_dicts: bool = False):
+    assert diagram_type in ["voronoi", "skeleton", "skeleton_structure", "skeleton_way"]
+    with open(path_to_file, "r") as f:
+        file_raw = f.read()
+    sections = file_raw.split(total_sep)
+    if diagram_type == "voronoi":
+        polygons_raw, edges_raw = sections
+        res = (parse_polygons_arrays(polygons_raw), parse_edges_arrays(edges_raw))
+        converters = (polygons_arrays_to_dicts, edges_arrays_to_dicts)
+    elif diagram_type == "skeleton":
+        polygons_raw, edges_raw, nodes_raw = sections
+        res = (parse_polygons_arrays(polygons_raw), parse_edges_arrays(edges_raw), parse_nodes_arrays(nodes_raw))
+        converters = (polygons_arrays_to_dicts, edges_arrays_to_dicts, nodes_arrays_to_dicts)
+    elif diagram_type == "skeleton_structure":
+        polygons_raw, edges_raw, nodes_raw = sections
+        res = (parse_polygons_arrays(polygons_raw), parse_structure_edges_arrays(edges_raw),
+               parse_structure_nodes_arrays(nodes_raw))
+        converters = (polygons_arrays_to_dicts, structure_edges_arrays_to_dicts, nodes_arrays_to_dicts)
+    else:
+        if len(sections) == 1:
+            count_terminals = int(sections[0].split('\n')[1])
+            res = (count_terminals, parse_nodes_arrays(""), parse_edges_arrays("EDGES"), parse_nodes_arrays(""))
+        else:
+            count_terminals_raw, nodes_raw, edges_raw, skeleton_way_raw = sections
+            count_terminals = int(count_terminals_raw.split('\n')[-1])
+            res = (count_terminals, parse_nodes_arrays(nodes_raw), parse_edges_arrays(edges_raw),
+                   parse_nodes_arrays(skeleton_way_raw))
+        converters = (int, nodes_arrays_to_dicts, edges_arrays_to_dicts, nodes_arrays_to_dicts)
+    if as_dicts:
+        return tuple(converter(parsed) for converter, parsed in zip(converters, res))
+    return res
@@ -0,0 +1,71 @@
+from PIL import Image, ImageDraw
+
+
+def calculate_bb(point: tuple, radius: float):
+    left_upper_point = (point[0] - radius, point[1] - radius)
+    right_upper_point = (point[0] + radius, point[1] + radius)
+    return [left_upper_point, right_upper_point]
+
+
+def render_polygons(polygons, image_size: tuple = (900, 900)) -> Image.Image:
+    img = Image.new("RGB", image_size, (255, 255, 255))
+    d = ImageDraw.Draw(img)
+    for polygon in polygons:
+        d.polygon(polygon, outline=(0, 0, 0))
+    return img
+
+
+def render_edges(img: Image.Image, edges) -> Image.Image:
+    d = ImageDraw.Draw(img)
+    for edge in edges:
+        d.line([edge["first_point"], edge["second_point"]], fill=(256, 0, 0))
+    return img
+
+
+def render_voronoi(polygons, edges, image_size: tuple = (900, 900)) -> Image.Image:
+    return render_edges(render_polygons(polygons, image_size), edges)
+
+
+def render_skeleton(polygons, edges, nodes, image_size: tuple = (900, 900),
+                    draw_circles: bool = False) -> Image.Image:
+    img = render_edges(render_polygons(polygons, image_size), edges)
+    if draw_circles:
+        d = ImageDraw.Draw(img)
+        for node in nodes:
+            bb = calculate_bb(node["point"], node["radius"])
+            d.ellipse(bb, outline=0)
+    return img
+
+
+def render_skeleton_way(polygons, skeleton_way, image_size: tuple = (900, 900), draw_circles: bool = False,
+                        draw_numbers: bool = False) -> Image.Image:
+    img = render_polygons(polygons, image_size)
+    if not skeleton_way:
+        return img
+    d = ImageDraw.Draw(img)
+    for i in range(len(skeleton_way) - 1):
+        cur_node, next_node = skeleton_way[i], skeleton_way[i + 1]
+        d.line([cur_node["point"], next_node["point"]], fill=(256, 0, 0))
+    if draw_circles:
+        for i, node in enumerate(skeleton_way, 1):
+            bb = calculate_bb(node["point"], node["radius"])
+            d.ellipse(bb, outline=0)
+            if draw_numbers:
+                d.text(node["point"], str(i), (0, 0, 0))
+    return img
+
+
+def tile_images(images, columns: int, tile_size: tuple = None, padding: int = 4) -> Image.Image:
+    if len(images) == 0:
+        raise ValueError("no images to tile")
+    if tile_size is None:
+        tile_size = images[0].size
+    rows = -(-len(images) // columns)
+    sheet = Image.new("RGB", (columns * (tile_size[0] + padding) + padding, rows * (tile_size[1] + padding) + padding),
+                      (255, 255, 255))
+    for i, img in enumerate(images):
+        if img.size != tuple(tile_size):
+            img = img.resize(tile_size)
+        row, column = divmod(i, columns)
+        sheet.paste(img, (padding + column * (tile_size[0] + padding), padding + row * (tile_size[1] + padding)))
+    return sheet
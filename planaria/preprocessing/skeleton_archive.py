@@ -0,0 +1,131 @@
+import os
+import json
+import mmap
+import struct
+from typing import List
+import numpy as np
+from .read_data import parse_file_arrays
+from .skeleton_way import SkeletonWay
+
+ARCHIVE_MAGIC = b"PLANARIA"
+ARCHIVE_VERSION = 1
+ARCHIVE_ALIGNMENT = 64
+
+
+def _concatenate(arrays: List[np.ndarray], dtype) -> np.ndarray:
+    return np.concatenate([np.asarray(array, dtype=dtype) for array in arrays] + [np.empty(0, dtype=dtype)])
+
+
+def _offsets(arrays: List[np.ndarray]) -> np.ndarray:
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(array) for array in arrays])
+    return offsets
+
+
+def write_skeleton_archive(archive_path: str, skeleton_files: List[str], class_labels: List[int],
+                           sample_names: List[str]) -> None:
+    num_terminals, x, y, radius, straight_x, straight_radius = [], [], [], [], [], []
+    for skeleton_file in skeleton_files:
+        count_terminals, _, _, skeleton_way = parse_file_arrays(skeleton_file, diagram_type="skeleton_way")
+        num_terminals.append(count_terminals)
+        x.append(skeleton_way["points"][:, 0])
+        y.append(skeleton_way["points"][:, 1])
+        radius.append(skeleton_way["radius"])
+        # straightened profiles are stored too, so loading does not recompute them
+        skeleton = SkeletonWay.from_arrays(count_terminals, x[-1], y[-1], radius[-1])
+        skeleton_x, skeleton_radius = skeleton.get_straight_profile()
+        straight_x.append(skeleton_x)
+        straight_radius.append(skeleton_radius)
+    names_encoded = [name.encode("utf-8") for name in sample_names]
+
+    arrays = {
+        "x": _concatenate(x, np.float64),
+        "y": _concatenate(y, np.float64),
+        "radius": _concatenate(radius, np.float64),
+        "offsets": _offsets(x),
+        "straight_x": _concatenate(straight_x, np.float64),
+        "straight_radius": _concatenate(straight_radius, np.float64),
+        "straight_offsets": _offsets(straight_x),
+        "num_terminals": np.asarray(num_terminals, dtype=np.int64),
+        "class_labels": np.asarray(class_labels, dtype=np.int64),
+        "names": np.frombuffer(b"".join(names_encoded), dtype=np.uint8),
+        "name_offsets": _offsets(names_encoded),
+    }
+
+    header = {"version": ARCHIVE_VERSION, "num_samples": len(skeleton_files), "arrays": dict()}
+    position = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": position}
+        position += -(-array.nbytes // ARCHIVE_ALIGNMENT) * ARCHIVE_ALIGNMENT
+    header_raw = json.dumps(header).encode("utf-8")
+    data_start = -(-(len(ARCHIVE_MAGIC) + 8 + len(header_raw)) // ARCHIVE_ALIGNMENT) * ARCHIVE_ALIGNMENT
+
+    tmp_path = archive_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(ARCHIVE_MAGIC)
+        f.write(struct.pack("<Q", len(header_raw)))
+        f.write(header_raw)
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + position)
+    os.replace(tmp_path, archive_path)
+
+
+class SkeletonArchive:
+    def __init__(self, archive_path: str):
+        self.archive_path = archive_path
+        with open(archive_path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._buffer[:len(ARCHIVE_MAGIC)] == ARCHIVE_MAGIC
+        header_len, = struct.unpack_from("<Q", self._buffer, len(ARCHIVE_MAGIC))
+        header_start = len(ARCHIVE_MAGIC) + 8
+        header = json.loads(self._buffer[header_start:header_start + header_len].decode("utf-8"))
+        assert header["version"] == ARCHIVE_VERSION
+        data_start = -(-(header_start + header_len) // ARCHIVE_ALIGNMENT) * ARCHIVE_ALIGNMENT
+
+        self.num_samples = header["num_samples"]
+        self._arrays = dict()
+        for name, description in header["arrays"].items():
+            dtype, shape = np.dtype(description["dtype"]), tuple(description["shape"])
+            # views over the mapped pages, nothing is copied
+            self._arrays[name] = np.frombuffer(self._buffer, dtype=dtype, count=int(np.prod(shape)),
+                                               offset=data_start + description["offset"]).reshape(shape)
+        self.class_labels = self._arrays["class_labels"]
+        self.num_terminals = self._arrays["num_terminals"]
+        self._name_index = None
+
+    def __len__(self):
+        return self.num_samples
+
+    def get_sample_name(self, i: int) -> str:
+        name_offsets = self._arrays["name_offsets"]
+        return self._arrays["names"][name_offsets[i]:name_offsets[i + 1]].tobytes().decode("utf-8")
+
+    def get_sample_names(self) -> List[str]:
+        return [self.get_sample_name(i) for i in range(self.num_samples)]
+
+    def index(self, sample_name: str) -> int:
+        if self._name_index is None:
+            self._name_index = dict()
+            for i, name in enumerate(self.get_sample_names()):
+                self._name_index.setdefault(name, i)
+        return self._name_index[sample_name]
+
+    def get_array(self, name: str) -> np.ndarray:
+        return self._arrays[name]
+
+    def get_skeleton(self, i: int) -> SkeletonWay:
+        start, end = self._arrays["offsets"][i:i + 2]
+        straight_start, straight_end = self._arrays["straight_offsets"][i:i + 2]
+        return SkeletonWay.from_arrays(self.num_terminals[i],
+                                       self._arrays["x"][start:end],
+                                       self._arrays["y"][start:end],
+                                       self._arrays["radius"][start:end],
+                                       self._arrays["straight_x"][straight_start:straight_end],
+                                       self._arrays["straight_radius"][straight_start:straight_end])
+
+    def __getitem__(self, key) -> SkeletonWay:
+        if isinstance(key, str):
+            key = self.index(key)
+        return self.get_skeleton(key)
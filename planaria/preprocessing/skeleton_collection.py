@@ -0,0 +1,225 @@
+from typing import Dict, List, Tuple
+import numpy as np
+from .read_data import parse_file_arrays
+from .skeleton_way import SkeletonWay
+from .skeleton_archive import SkeletonArchive
+
+
+def _segment_ids(offsets: np.ndarray) -> np.ndarray:
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _concatenate(arrays: List[np.ndarray]) -> np.ndarray:
+    return np.concatenate([np.asarray(array, dtype=float) for array in arrays] + [np.empty(0)])
+
+
+def _offsets(counts) -> np.ndarray:
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    return offsets
+
+
+class SkeletonCollection:
+    # Skeleton ways of a whole cohort as concatenated node arrays: nodes of skeleton i are
+    # offsets[i]:offsets[i + 1], its straightened profile is straight_offsets[i]:straight_offsets[i + 1].
+    # Empty skeletons have empty segments, their features are NaN as in SkeletonWay.
+    def __init__(self, num_terminals, x, y, radius, offsets, class_labels, sample_names,
+                 straight_x=None, straight_radius=None, straight_offsets=None):
+        self.num_terminals = np.asarray(num_terminals, dtype=np.int64)
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.radius = np.asarray(radius, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.class_labels = np.asarray(class_labels, dtype=np.int64)
+        self.sample_names = list(sample_names)
+        if straight_x is None:
+            self.straighten()
+        else:
+            self.straight_x = np.asarray(straight_x, dtype=float)
+            self.straight_radius = np.asarray(straight_radius, dtype=float)
+            self.straight_offsets = np.asarray(straight_offsets, dtype=np.int64)
+
+    @classmethod
+    def from_skeleton_files(cls, skeleton_files: List[str], class_labels: List[int], sample_names: List[str]):
+        num_terminals, x, y, radius = [], [], [], []
+        for skeleton_file in skeleton_files:
+            count_terminals, _, _, skeleton_way = parse_file_arrays(skeleton_file, diagram_type="skeleton_way")
+            num_terminals.append(count_terminals)
+            x.append(skeleton_way["points"][:, 0])
+            y.append(skeleton_way["points"][:, 1])
+            radius.append(skeleton_way["radius"])
+        return cls(num_terminals, _concatenate(x), _concatenate(y), _concatenate(radius),
+                   _offsets([len(array) for array in x]), class_labels, sample_names)
+
+    @classmethod
+    def from_archive(cls, archive: SkeletonArchive):
+        # the arrays stay views over the mapped archive
+        return cls(archive.num_terminals, archive.get_array("x"), archive.get_array("y"), archive.get_array("radius"),
+                   archive.get_array("offsets"), archive.class_labels, archive.get_sample_names(),
+                   archive.get_array("straight_x"), archive.get_array("straight_radius"),
+                   archive.get_array("straight_offsets"))
+
+    @classmethod
+    def from_skeletons(cls, skeletons: List[SkeletonWay], class_labels: List[int], sample_names: List[str]):
+        nodes = [skeleton.get_nodes() for skeleton in skeletons]
+        profiles = [skeleton.get_straight_profile() for skeleton in skeletons]
+        return cls([skeleton.num_terminals for skeleton in skeletons], _concatenate([x for x, _, _ in nodes]),
+                   _concatenate([y for _, y, _ in nodes]), _concatenate([radius for _, _, radius in nodes]),
+                   _offsets([len(x) for x, _, _ in nodes]), class_labels, sample_names,
+                   _concatenate([x for x, _ in profiles]), _concatenate([radius for _, radius in profiles]),
+                   _offsets([len(x) for x, _ in profiles]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def straighten(self) -> None:
+        # SkeletonWay.__straight_skeleton_way for all skeletons at once: the first node of every skeleton
+        # opens its profile at zero, every other node is kept if the edge leading to it is not zero-length
+        num_nodes = len(self.x)
+        is_first = np.zeros(num_nodes, dtype=bool)
+        is_first[self.offsets[:-1][np.diff(self.offsets) > 0]] = True
+        edge_lengths = np.zeros(num_nodes)
+        edge_lengths[1:] = np.hypot(np.diff(self.x), np.diff(self.y))
+        keep = is_first | (edge_lengths != 0)
+        edge_lengths[is_first] = 0.0
+
+        segment_ids = _segment_ids(self.offsets)[keep]
+        self.straight_offsets = _offsets(np.bincount(segment_ids, minlength=len(self)))
+        # segmented cumsum over the flat array: every profile starts by taking back the total of the one
+        # before it, so the running sum stays at the scale of one profile instead of the whole cohort
+        increments = edge_lengths[keep]
+        starts = self.straight_offsets[:-1][np.diff(self.straight_offsets) > 0]
+        if len(starts) > 1:
+            increments[starts[1:]] -= np.add.reduceat(increments, starts)[:-1]
+        cumulative = np.cumsum(increments)
+        self.straight_x = cumulative - cumulative[self.straight_offsets[segment_ids]]
+        self.straight_radius = np.where(is_first, 0.0, self.radius)[keep]
+
+    def fix_head_tail(self) -> None:
+        # the fix_head_tail_skeleton_way rule: a profile is reversed when it is wider at the tail
+        starts, ends = self.straight_offsets[:-1], self.straight_offsets[1:]
+        reverse = np.zeros(len(self), dtype=bool)
+        valid = ends - starts >= 2
+        reverse[valid] = self.straight_radius[starts[valid] + 1] < self.straight_radius[ends[valid] - 2]
+        if not reverse.any():
+            return
+        segment_ids = _segment_ids(self.straight_offsets)
+        positions = np.arange(len(self.straight_x))
+        reversed_nodes = reverse[segment_ids]
+        source = np.where(reversed_nodes, starts[segment_ids] + ends[segment_ids] - 1 - positions, positions)
+        lengths = np.zeros(len(self))
+        lengths[reverse] = self.straight_x[ends[reverse] - 1]
+        self.straight_x = np.where(reversed_nodes, lengths[segment_ids] - self.straight_x[source], self.straight_x)
+        self.straight_radius = self.straight_radius[source]
+
+    def calculate_lengths(self) -> np.ndarray:
+        starts, ends = self.straight_offsets[:-1], self.straight_offsets[1:]
+        lengths = np.full(len(self), np.nan)
+        non_empty = ends > starts
+        lengths[non_empty] = self.straight_x[ends[non_empty] - 1]
+        return lengths
+
+    def get_features(self) -> Dict[str, np.ndarray]:
+        # columns as calculate_features_columns gives them for the same skeletons
+        starts, ends = self.straight_offsets[:-1], self.straight_offsets[1:]
+        counts = ends - starts
+        non_empty = counts > 0
+        segment_ids = _segment_ids(self.straight_offsets)
+
+        # pairs of neighbouring nodes from different segments are not edges
+        same_segment = segment_ids[:-1] == segment_ids[1:]
+        trapezoids = (np.diff(self.straight_x) * (self.straight_radius[:-1] + self.straight_radius[1:]))[same_segment]
+        squares = np.bincount(segment_ids[:-1][same_segment], weights=trapezoids, minlength=len(self))
+        squares[~non_empty] = np.nan
+        lengths = self.calculate_lengths()
+
+        max_radius = np.full(len(self), np.nan)
+        median_radius = np.full(len(self), np.nan)
+        if non_empty.any():
+            max_radius[non_empty] = np.maximum.reduceat(self.straight_radius, starts[non_empty])
+            # radii sorted inside every segment give the medians by position
+            sorted_radius = self.straight_radius[np.lexsort((self.straight_radius, segment_ids))]
+            lower = starts + (counts - 1) // 2
+            upper = starts + counts // 2
+            median_radius[non_empty] = (sorted_radius[lower[non_empty]] + sorted_radius[upper[non_empty]]) / 2
+
+        num_lines = counts if non_empty.all() else np.where(non_empty, counts, np.nan)
+        res = dict()
+        res["num_terminal_nodes"] = self.num_terminals.copy()
+        res["skeleton_length"] = lengths
+        res["skeleton_square"] = squares
+        res["skeleton_mean_radius"] = squares / 2 / lengths
+        res["skeleton_max_radius"] = max_radius
+        res["skeleton_median_radius"] = median_radius
+        res["skeleton_num_lines"] = num_lines
+        return res
+
+    def filter_length(self, len_threshold: float):
+        # same rule as Preprocesser.iter_skeletons: drops empty skeletons and those at least len_threshold long
+        lengths = self.calculate_lengths()
+        return self.take(np.flatnonzero(~np.isnan(lengths) & (lengths < len_threshold)))
+
+    def pack_profiles(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # the layout of shape_matching.pack_profiles
+        return self.straight_x, self.straight_radius, self.straight_offsets
+
+    def __slice(self, start: int, stop: int):
+        # contiguous ranges are views, only the offsets are rebased
+        node_start, node_stop = self.offsets[start], self.offsets[stop]
+        straight_start, straight_stop = self.straight_offsets[start], self.straight_offsets[stop]
+        return SkeletonCollection(self.num_terminals[start:stop], self.x[node_start:node_stop],
+                                  self.y[node_start:node_stop], self.radius[node_start:node_stop],
+                                  self.offsets[start:stop + 1] - node_start, self.class_labels[start:stop],
+                                  self.sample_names[start:stop],
+                                  self.straight_x[straight_start:straight_stop],
+                                  self.straight_radius[straight_start:straight_stop],
+                                  self.straight_offsets[start:stop + 1] - straight_start)
+
+    def take(self, indices):
+        # arbitrary subsets are gathered into new arrays
+        indices = np.asarray(indices, dtype=np.int64)
+
+        def gather(values, offsets):
+            counts = np.diff(offsets)[indices]
+            new_offsets = _offsets(counts)
+            positions = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1] - offsets[indices], counts)
+            return values[positions], new_offsets
+
+        x, offsets = gather(self.x, self.offsets)
+        straight_x, straight_offsets = gather(self.straight_x, self.straight_offsets)
+        return SkeletonCollection(self.num_terminals[indices], x, gather(self.y, self.offsets)[0],
+                                  gather(self.radius, self.offsets)[0], offsets, self.class_labels[indices],
+                                  [self.sample_names[i] for i in indices], straight_x,
+                                  gather(self.straight_radius, self.straight_offsets)[0], straight_offsets)
+
+    def get_skeleton(self, i: int) -> SkeletonWay:
+        start, end = self.offsets[i:i + 2]
+        straight_start, straight_end = self.straight_offsets[i:i + 2]
+        return SkeletonWay.from_arrays(self.num_terminals[i], self.x[start:end], self.y[start:end],
+                                       self.radius[start:end], self.straight_x[straight_start:straight_end],
+                                       self.straight_radius[straight_start:straight_end])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return self.__slice(start, max(start, stop))
+            return self.take(np.arange(start, stop, step))
+        if isinstance(key, (int, np.integer)):
+            return self.get_skeleton(key)
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        return self.take(key)
+
+    def to_skeletons(self) -> List[SkeletonWay]:
+        return [self.get_skeleton(i) for i in range(len(self))]
+
+    def index(self, sample_name: str) -> int:
+        return self.sample_names.index(sample_name)
+
+    def get_sample_name(self, i: int) -> str:
+        return self.sample_names[i]
+
+    def __repr__(self):
+        return "SkeletonCollection({} skeletons, {} nodes)".format(len(self), len(self.x))
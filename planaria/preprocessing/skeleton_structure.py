@@ -1,7 +1,10 @@
-from PIL import Image, ImageDraw
-from .read_data import parse_file
-from .draw_data import calculate_bb
-from typing import Tuple
+from collections import defaultdict
+from .read_data import parse_file_arrays, polygons_arrays_to_dicts
+from .skeleton_way import SkeletonWay
+from typing import List, Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
 
 
 class SkeletonNode:
@@ -30,39 +33,185 @@ class SkeletonEdge:
 
 
 class Skeleton:
+    # Skeleton graph in CSR form: the neighbours of node i are indices[indptr[i]:indptr[i + 1]] and
+    # edge_ids gives the edge behind every neighbour entry. Nodes are addressed by their position,
+    # node_ids keeps the ids from the file.
     def __init__(self, skeleton_file: str):
         self.skeleton_file = skeleton_file
-        polygons, edges, nodes = parse_file(skeleton_file, diagram_type="skeleton_structure")
-        self.polygons = polygons
-        self.edges = []
-        self.nodes = dict()
-        self.__add_nodes(nodes)
-        self.__add_edges(edges)
-
-    def __add_nodes(self, nodes):
-        for node in nodes:
-            new_node = SkeletonNode(node["id"], node["point"], node["radius"])
-            self.nodes[node["id"]] = new_node
-
-    def __add_edges(self, edges):
-        for edge in edges:
-            first_node_id, second_node_id = edge["first_node"], edge["second_node"]
-            new_edge = SkeletonEdge(first_node_id, second_node_id)
-            self.edges.append(new_edge)
-            self.nodes[first_node_id].add_edge(new_edge)
-            self.nodes[second_node_id].add_edge(new_edge)
+        polygons, edges, nodes = parse_file_arrays(skeleton_file, diagram_type="skeleton_structure")
+        node_index = {node_id: i for i, node_id in enumerate(nodes["ids"].tolist())}
+        first_nodes = np.array([node_index[node_id] for node_id in edges["first_nodes"].tolist()], dtype=np.int64)
+        second_nodes = np.array([node_index[node_id] for node_id in edges["second_nodes"].tolist()], dtype=np.int64)
+        self.__set_arrays(nodes["ids"], nodes["points"], nodes["radius"], first_nodes, second_nodes, polygons)
+
+    @classmethod
+    def from_arrays(cls, node_ids: np.ndarray, points: np.ndarray, radius: np.ndarray, first_nodes: np.ndarray,
+                    second_nodes: np.ndarray, polygons: Optional[dict] = None, skeleton_file: Optional[str] = None):
+        skeleton = cls.__new__(cls)
+        skeleton.skeleton_file = skeleton_file
+        skeleton.__set_arrays(node_ids, points, radius, first_nodes, second_nodes, polygons)
+        return skeleton
+
+    def __set_arrays(self, node_ids, points, radius, first_nodes, second_nodes, polygons):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.radius = np.asarray(radius, dtype=float)
+        self.first_nodes = np.asarray(first_nodes, dtype=np.int64)
+        self.second_nodes = np.asarray(second_nodes, dtype=np.int64)
+        self._polygons = polygons
+        self._nodes, self._edges = None, None
+
+        num_nodes, num_edges = len(self.node_ids), len(self.first_nodes)
+        self.edge_lengths = np.hypot(*(self.points[self.first_nodes] - self.points[self.second_nodes]).T)
+        sources = np.concatenate([self.first_nodes, self.second_nodes])
+        order = np.argsort(sources, kind="stable")
+        self.indices = np.concatenate([self.second_nodes, self.first_nodes])[order]
+        self.edge_ids = np.tile(np.arange(num_edges), 2)[order]
+        self.indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(np.bincount(sources, minlength=num_nodes))
+
+    @property
+    def degrees(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    @property
+    def num_terminals(self) -> int:
+        return int(np.count_nonzero(self.degrees == 1))
+
+    @property
+    def polygons(self) -> List[List[tuple]]:
+        if self._polygons is None:
+            return []
+        return polygons_arrays_to_dicts(self._polygons)
+
+    @property
+    def nodes(self):
+        # object view in the old per-node format, built on first access
+        if self._nodes is None:
+            self._nodes = dict()
+            for node_id, point, radius in zip(self.node_ids.tolist(), self.points.tolist(), self.radius.tolist()):
+                self._nodes[node_id] = SkeletonNode(node_id, tuple(point), radius)
+            for edge in self.edges:
+                self._nodes[edge.first_node_id].add_edge(edge)
+                self._nodes[edge.second_node_id].add_edge(edge)
+        return self._nodes
+
+    @property
+    def edges(self):
+        if self._edges is None:
+            self._edges = [SkeletonEdge(first_node_id, second_node_id) for first_node_id, second_node_id in
+                           zip(self.node_ids[self.first_nodes].tolist(), self.node_ids[self.second_nodes].tolist())]
+        return self._edges
+
+    def adjacency_matrix(self) -> csr_matrix:
+        num_nodes = len(self.node_ids)
+        return csr_matrix((self.edge_lengths[self.edge_ids], self.indices, self.indptr), shape=(num_nodes, num_nodes))
+
+    def subgraph(self, edge_mask: np.ndarray):
+        # keeps the masked edges and the nodes they touch
+        first_nodes, second_nodes = self.first_nodes[edge_mask], self.second_nodes[edge_mask]
+        kept_nodes, inverse = np.unique(np.concatenate([first_nodes, second_nodes]), return_inverse=True)
+        return Skeleton.from_arrays(self.node_ids[kept_nodes], self.points[kept_nodes], self.radius[kept_nodes],
+                                    inverse[:len(first_nodes)], inverse[len(first_nodes):], self._polygons,
+                                    self.skeleton_file)
+
+    def __trace_branch(self, terminal: int, degrees: List[int], active: List[bool], indptr: List[int],
+                       indices: List[int], edge_ids: List[int]) -> Tuple[List[int], float, int]:
+        # walks from a terminal node through degree-2 nodes up to a junction or another terminal
+        branch_edges, length = [], 0.0
+        came_by, current = -1, terminal
+        while True:
+            step = next((k for k in range(indptr[current], indptr[current + 1])
+                         if active[edge_ids[k]] and edge_ids[k] != came_by), None)
+            if step is None:
+                return branch_edges, length, current
+            came_by, current = edge_ids[step], indices[step]
+            branch_edges.append(came_by)
+            length += self.edge_lengths[came_by]
+            if degrees[current] != 2:
+                return branch_edges, length, current
+
+    def prune(self, min_length: float = 0.0, radius_factor: float = 0.0):
+        # Removes terminal branches shorter than min_length or than radius_factor times the radius of
+        # the junction they grow from, repeating until nothing changes. A junction never loses its last
+        # two branches, so the main path survives.
+        active = [True] * len(self.first_nodes)
+        indptr, indices, edge_ids = self.indptr.tolist(), self.indices.tolist(), self.edge_ids.tolist()
+        first_nodes, second_nodes = self.first_nodes.tolist(), self.second_nodes.tolist()
+        radius = self.radius.tolist()
+        # degrees are updated as branches go; pruning never makes new terminals and a branch only changes
+        # when the node it ends at loses a branch, so each round traces only the terminals ending at such nodes
+        degrees = self.degrees.tolist()
+        branch_ends, terminals_by_end = dict(), defaultdict(list)
+        terminals = [i for i, degree in enumerate(degrees) if degree == 1]
+        while terminals:
+            branches = []
+            for terminal in terminals:
+                branch_edges, length, end = self.__trace_branch(terminal, degrees, active, indptr, indices, edge_ids)
+                branch_ends[terminal] = end
+                terminals_by_end[end].append(terminal)
+                if degrees[end] > 2 and length < max(min_length, radius_factor * radius[end]):
+                    branches.append((length, branch_edges, terminal, end))
+            changed_ends = set()
+            for length, branch_edges, terminal, end in sorted(branches, key=lambda branch: branch[0]):
+                if degrees[end] <= 2:
+                    continue
+                for edge_id in branch_edges:
+                    active[edge_id] = False
+                    degrees[first_nodes[edge_id]] -= 1
+                    degrees[second_nodes[edge_id]] -= 1
+                changed_ends.add(end)
+            # the lists keep terminals that have moved on to other ends since, branch_ends filters them
+            terminals = sorted({terminal for end in changed_ends for terminal in terminals_by_end.pop(end)
+                                if branch_ends[terminal] == end and degrees[terminal] == 1})
+        return self.subgraph(np.array(active, dtype=bool))
+
+    def longest_path(self) -> np.ndarray:
+        # Double sweep: the farthest node from any node of a tree is an end of its longest path, and the
+        # farthest node from that end is the other one. All components are swept at once; the path of
+        # the component with the largest diameter is returned as node positions.
+        if len(self.node_ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        graph = self.adjacency_matrix()
+        num_components, labels = connected_components(graph, directed=False)
+        starts = np.unique(labels, return_index=True)[1]
+        distances = dijkstra(graph, directed=False, indices=starts, min_only=True)
+        ends = self.__farthest_nodes(distances, labels, num_components)
+        distances, predecessors, _ = dijkstra(graph, directed=False, indices=ends, min_only=True,
+                                              return_predecessors=True)
+        other_ends = self.__farthest_nodes(distances, labels, num_components)
+        node = other_ends[np.argmax(distances[other_ends])]
+        path = [node]
+        while predecessors[node] >= 0:
+            node = predecessors[node]
+            path.append(node)
+        return np.array(path, dtype=np.int64)
+
+    @staticmethod
+    def __farthest_nodes(distances: np.ndarray, labels: np.ndarray, num_components: int) -> np.ndarray:
+        order = np.lexsort((distances, labels))
+        last_of_component = np.cumsum(np.bincount(labels, minlength=num_components)) - 1
+        return order[last_of_component]
+
+    def to_skeleton_way(self, min_length: float = 0.0, radius_factor: float = 0.0) -> SkeletonWay:
+        # the "skeleton way" of the _skeleton_extra.txt files: main path nodes and the number of terminals
+        skeleton = self.prune(min_length, radius_factor) if min_length > 0 or radius_factor > 0 else self
+        path = skeleton.longest_path()
+        return SkeletonWay.from_arrays(skeleton.num_terminals, skeleton.points[path, 0], skeleton.points[path, 1],
+                                       skeleton.radius[path])
 
     def draw_skeleton(self, image_size: tuple = (900, 900), draw_circles: bool = False):
+        from PIL import Image, ImageDraw
+        from .render import calculate_bb
         img = Image.new("RGB", image_size, (255, 255, 255))
         d = ImageDraw.Draw(img)
         for polygon in self.polygons:
             d.polygon(polygon, outline=(0, 0, 0))
-        for edge in self.edges:
-            first_point = self.nodes[edge.first_node_id].point
-            second_point = self.nodes[edge.second_node_id].point
-            d.line([first_point, second_point], fill=(256, 0, 0))
+        points = self.points.tolist()
+        for first_node, second_node in zip(self.first_nodes.tolist(), self.second_nodes.tolist()):
+            d.line([tuple(points[first_node]), tuple(points[second_node])], fill=(256, 0, 0))
         if draw_circles:
-            for _, node in self.nodes.items():
-                bb = calculate_bb(node.point, node.radius)
+            for point, radius in zip(points, self.radius.tolist()):
+                bb = calculate_bb(point, radius)
                 d.ellipse(bb, outline=0)
         return img
@@ -1,124 +1,163 @@
-from .read_data import parse_file
-from .draw_data import calculate_bb
-from typing import Tuple
-from PIL import Image, ImageDraw
+from .read_data import parse_file_arrays
+from typing import TYPE_CHECKING, Tuple
 import numpy as np
+from planaria.instrumentation import stage
+
+if TYPE_CHECKING:
+    from PIL import Image
 
 
 class SkeletonWay:
+    __slots__ = ("num_terminals", "_x", "_y", "_radius", "_straight_x", "_straight_radius", "_features")
+
     def __init__(self, path_to_skeleton_way: str):
-        self.num_terminals, _, _, self._skeleton_way = parse_file(path_to_skeleton_way, diagram_type="skeleton_way")
-        self.num_terminals = int(self.num_terminals)
-        if len(self._skeleton_way) == 0:
-            self._skeleton_way_straight = None
+        num_terminals, _, _, skeleton_way = parse_file_arrays(path_to_skeleton_way, diagram_type="skeleton_way")
+        self.__set_arrays(num_terminals, skeleton_way["points"][:, 0], skeleton_way["points"][:, 1],
+                          skeleton_way["radius"])
+
+    @classmethod
+    def from_arrays(cls, num_terminals: int, x: np.ndarray, y: np.ndarray, radius: np.ndarray,
+                    straight_x: np.ndarray = None, straight_radius: np.ndarray = None):
+        skeleton_way = cls.__new__(cls)
+        skeleton_way.__set_arrays(num_terminals, x, y, radius, straight_x, straight_radius)
+        return skeleton_way
+
+    @classmethod
+    def from_skeleton_structure(cls, path_to_skeleton_structure: str, min_length: float = 0.0,
+                                radius_factor: float = 0.0):
+        # builds the skeleton way from the full skeleton graph instead of a _skeleton_extra.txt file
+        from .skeleton_structure import Skeleton
+        return Skeleton(path_to_skeleton_structure).to_skeleton_way(min_length, radius_factor)
+
+    def __set_arrays(self, num_terminals, x, y, radius, straight_x=None, straight_radius=None):
+        self.num_terminals = int(num_terminals)
+        self._features = None
+        self._x = np.ascontiguousarray(x, dtype=float)
+        self._y = np.ascontiguousarray(y, dtype=float)
+        self._radius = np.ascontiguousarray(radius, dtype=float)
+        if len(self._radius) == 0:
+            self._straight_x, self._straight_radius = None, None
+        elif straight_x is not None:
+            self._straight_x = np.ascontiguousarray(straight_x, dtype=float)
+            self._straight_radius = np.ascontiguousarray(straight_radius, dtype=float)
         else:
             self.__straight_skeleton_way()
 
-    @staticmethod
-    def __compute_line_length(point_1: Tuple[float, float], point_2: Tuple[float, float]):
-        return ((point_1[0] - point_2[0]) ** 2 + (point_1[1] - point_2[1]) ** 2) ** 0.5
-
     def __straight_skeleton_way(self):
-        cur_x = 0
-        self._skeleton_way_straight = [{"point": (0.0, 0.0), "radius": 0.0}]
-        for i in range(1, len(self._skeleton_way)):
-            cur_node, prev_node = self._skeleton_way[i], self._skeleton_way[i - 1]
-            edge_length = self.__compute_line_length(cur_node["point"], prev_node["point"])
-            if edge_length == 0:
-                continue
-            cur_x += edge_length
-            self._skeleton_way_straight.append({"point": (cur_x, 0.0), "radius": cur_node["radius"]})
+        with stage("straighten"):
+            edge_lengths = np.hypot(np.diff(self._x), np.diff(self._y))
+            # zero-length edges are dropped together with their end node
+            non_zero = edge_lengths != 0
+            self._straight_x = np.concatenate([[0.0], np.cumsum(edge_lengths[non_zero])])
+            self._straight_radius = np.concatenate([[0.0], self._radius[1:][non_zero]])
 
     def __reverse_straight_skeleton_way(self):
-        res = []
-        length = self._skeleton_way_straight[-1]["point"][0]
-        for node in self._skeleton_way_straight[::-1]:
-            new_node = dict()
-            new_node["point"] = (length - node["point"][0], 0)
-            new_node["radius"] = node["radius"]
-            res.append(new_node)
-        self._skeleton_way_straight = res
+        self._straight_x = self._straight_x[-1] - self._straight_x[::-1]
+        self._straight_radius = self._straight_radius[::-1].copy()
+        self._features = None
 
     def fix_head_tail_skeleton_way(self):
-        if self._skeleton_way_straight is None:
+        if self._straight_x is None:
             return
-        start_rad = self._skeleton_way_straight[1]["radius"]
-        end_rad = self._skeleton_way_straight[-2]["radius"]
+        start_rad = self._straight_radius[1]
+        end_rad = self._straight_radius[-2]
         if start_rad < end_rad:
             self.__reverse_straight_skeleton_way()
 
     def draw_straight_skeleton_way(self, image_size: Tuple[int, int] = (900, 900),
-                                   draw_circles: bool = True) -> Image:
+                                   draw_circles: bool = True) -> "Image.Image":
+        # PIL and the render helpers are imported on first draw, so that feature workers never load them
+        from PIL import Image, ImageDraw
+        from .render import calculate_bb
         img = Image.new("RGB", image_size, (255, 255, 255))
         d = ImageDraw.Draw(img)
         y_image = image_size[1] // 2
 
-        for i in range(len(self._skeleton_way_straight) - 1):
-            cur_node, next_node = self._skeleton_way_straight[i], self._skeleton_way_straight[i + 1]
-            cur_draw_point = (cur_node["point"][0], y_image)
-            next_draw_point = (next_node["point"][0], y_image)
+        for i in range(len(self._straight_x) - 1):
+            cur_draw_point = (self._straight_x[i], y_image)
+            next_draw_point = (self._straight_x[i + 1], y_image)
             d.line([cur_draw_point, next_draw_point], fill=(256, 0, 0))
             if draw_circles:
-                bb = calculate_bb(cur_draw_point, cur_node["radius"])
+                bb = calculate_bb(cur_draw_point, self._straight_radius[i])
                 d.ellipse(bb, outline=0)
         return img
 
+    def __calculate_features(self) -> dict:
+        # every derived quantity is computed here in one go and cached until the profile changes
+        if self._features is not None:
+            return self._features
+        if self._straight_x is None:
+            nan = float("nan")
+            self._features = {"length": nan, "square": nan, "mean_radius": nan, "max_radius": nan,
+                              "median_radius": nan, "num_lines": nan}
+            return self._features
+        length = self._straight_x[-1]
+        square = float(np.dot(np.diff(self._straight_x), self._straight_radius[:-1] + self._straight_radius[1:]))
+        sorted_radius = np.sort(self._straight_radius)
+        num_lines = len(sorted_radius)
+        middle = num_lines // 2
+        if num_lines % 2:
+            median_radius = sorted_radius[middle]
+        else:
+            median_radius = (sorted_radius[middle - 1] + sorted_radius[middle]) / 2
+        self._features = {"length": length, "square": square, "mean_radius": square / 2 / length,
+                          "max_radius": sorted_radius[-1], "median_radius": median_radius, "num_lines": num_lines}
+        return self._features
+
     def calculate_length(self) -> float:
-        if not self._skeleton_way_straight:
-            return float("nan")
-        return self._skeleton_way_straight[-1]["point"][0]
+        return self.__calculate_features()["length"]
 
     def calculate_square(self) -> float:
-        if not self._skeleton_way_straight:
-            return float("nan")
-        square = 0
-        for i in range(1, len(self._skeleton_way_straight)):
-            prev_node, cur_node = self._skeleton_way_straight[i - 1], self._skeleton_way_straight[i]
-            prev_x, prev_radius = prev_node["point"][0], prev_node["radius"]
-            cur_x, cur_radius = cur_node["point"][0], cur_node["radius"]
-
-            edge_length = cur_x - prev_x
-            trapezoid_line = prev_radius + cur_radius
-
-            square += edge_length * trapezoid_line
-        return square
+        return self.__calculate_features()["square"]
 
     def calculate_mean_radius(self) -> float:
-        if not self._skeleton_way_straight:
-            return float("nan")
-        return self.calculate_square() / 2 / self.calculate_length()
+        return self.__calculate_features()["mean_radius"]
 
     def calculate_max_radius(self) -> float:
-        if not self._skeleton_way_straight:
-            return float("nan")
-        radii = []
-        for node in self._skeleton_way_straight:
-            radii.append(node["radius"])
-        return np.max(radii)
+        return self.__calculate_features()["max_radius"]
 
     def calculate_median_radius(self) -> float:
-        if not self._skeleton_way_straight:
-            return float("nan")
-        radii = []
-        for node in self._skeleton_way_straight:
-            radii.append(node["radius"])
-        return np.median(radii)
+        return self.__calculate_features()["median_radius"]
 
     def calculate_num_lines(self):
-        if not self._skeleton_way_straight:
-            return float("nan")
-        return len(self._skeleton_way_straight)
+        return self.__calculate_features()["num_lines"]
 
     def get_features(self):
+        features = self.__calculate_features()
         res = dict()
         res["num_terminal_nodes"] = self.num_terminals
-        res["skeleton_length"] = self.calculate_length()
-        res["skeleton_square"] = self.calculate_square()
-        res["skeleton_mean_radius"] = self.calculate_mean_radius()
-        res["skeleton_max_radius"] = self.calculate_max_radius()
-        res["skeleton_median_radius"] = self.calculate_median_radius()
-        res["skeleton_num_lines"] = self.calculate_num_lines()
+        res["skeleton_length"] = features["length"]
+        res["skeleton_square"] = features["square"]
+        res["skeleton_mean_radius"] = features["mean_radius"]
+        res["skeleton_max_radius"] = features["max_radius"]
+        res["skeleton_median_radius"] = features["median_radius"]
+        res["skeleton_num_lines"] = features["num_lines"]
         return res
 
+    def save(self, path_to_skeleton_way: str, total_sep: str = "\n\n\n\n") -> None:
+        # writes the _skeleton_extra.txt format; the skeleton way is also stored as the node list
+        sections = ["TERMINALS\n{}".format(self.num_terminals)]
+        if len(self._x) > 0:
+            x, y, radius = self._x.tolist(), self._y.tolist(), self._radius.tolist()
+            nodes = "NODES\n" + "\n".join("{!r} {!r}\t{!r}".format(*node) for node in zip(x, y, radius))
+            edges = "EDGES" + "".join("\n{!r} {!r} {!r} {!r}\t{!r} {!r}".format(x[i], y[i], x[i + 1], y[i + 1],
+                                                                              radius[i], radius[i + 1])
+                                      for i in range(len(x) - 1))
+            sections += [nodes, edges, nodes]
+        with open(path_to_skeleton_way, "w") as f:
+            f.write(total_sep.join(sections))
+
+    def get_nodes(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return self._x, self._y, self._radius
+
+    def get_straight_profile(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._straight_x is None:
+            return np.empty(0), np.empty(0)
+        return self._straight_x, self._straight_radius
+
     def get_straight_skeleton(self):
-        return self._skeleton_way_straight
+        # list-of-dicts view kept for callers written against the old node format
+        if self._straight_x is None:
+            return None
+        return [{"point": (x, 0.0), "radius": radius}
+                for x, radius in zip(self._straight_x.tolist(), self._straight_radius.tolist())]
@@ -1,18 +1,26 @@
 import os
+import json
+import hashlib
 from shutil import rmtree
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
 import numpy as np
 from skimage import io, img_as_ubyte
 from skimage import util, color, feature, filters
 from scipy import ndimage as ndi
 from planaria.config import PLANARIA_PHOTO_DIR_PATH, PLANARIA_SEGMENTATION_DIR_PATH
+from planaria.instrumentation import InstrumentedTask, instrumented, stage, unwrap
+from .tiled_segmentation import segment_planaria_photo_tiled
 
 
+@instrumented("find_planaria")
 def find_planaria(image: np.ndarray) -> np.ndarray:
     plan = util.img_as_float(image)
     # to black-white
     plan = color.rgb2gray(plan)
     # find edges with filter
-    plan = feature.canny(plan, sigma=3)
+    with stage("find_planaria.canny"):
+        plan = feature.canny(plan, sigma=3)
 
     # binarization of edges
     thresh = filters.threshold_otsu(plan)
@@ -21,7 +29,8 @@ def find_planaria(image: np.ndarray) -> np.ndarray:
 
     # fill contours
     binary_plan = ndi.binary_fill_holes(binary_plan).astype(float)
-    label_objects, num_labels = ndi.label(binary_plan)
+    with stage("find_planaria.label"):
+        label_objects, num_labels = ndi.label(binary_plan)
     # only for planaria
     sizes = np.bincount(label_objects.ravel())
     plan_index = np.argsort(sizes)[-2]
@@ -33,32 +42,275 @@ def find_planaria(image: np.ndarray) -> np.ndarray:
     return binary_cleaned
 
 
+def to_gray(image: np.ndarray) -> np.ndarray:
+    # float32 luminance in [0, 1] without materializing a float copy of every channel
+    scale = 1.0 / np.iinfo(image.dtype).max if np.issubdtype(image.dtype, np.integer) else 1.0
+    if image.ndim == 2:
+        return image.astype(np.float32) * np.float32(scale)
+    gray = np.zeros(image.shape[:2], dtype=np.float32)
+    for channel, coef in enumerate((0.2125, 0.7154, 0.0721)):
+        gray += image[..., channel] * np.float32(coef * scale)
+    return gray
+
+
+def largest_component(binary: np.ndarray) -> np.ndarray:
+    label_objects, num_labels = ndi.label(binary)
+    if num_labels == 0:
+        return np.zeros(binary.shape, dtype=bool)
+    sizes = np.bincount(label_objects.ravel())
+    sizes[0] = 0
+    return label_objects == np.argmax(sizes)
+
+
+def fill_planaria_edges(gray: np.ndarray, sigma: float = 3, dilation_size: int = 5) -> np.ndarray:
+    edges = feature.canny(gray, sigma=sigma)
+    binary = ndi.binary_dilation(edges, structure=np.ones((dilation_size, dilation_size), dtype=bool))
+    return ndi.binary_fill_holes(binary)
+
+
+def detect_planaria_mask(gray: np.ndarray, sigma: float = 3, dilation_size: int = 5) -> np.ndarray:
+    return largest_component(fill_planaria_edges(gray, sigma=sigma, dilation_size=dilation_size))
+
+
+@instrumented("find_planaria_objects")
+def find_planaria_objects(image: np.ndarray, min_area: int = 1000,
+                          max_area: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Every filled component with min_area <= area <= max_area, from one labelling pass. Returns the
+    # label map with the kept objects numbered 1..n (0 elsewhere), their areas and their bounding boxes
+    # as (row_start, row_end, col_start, col_end) rows.
+    binary = fill_planaria_edges(to_gray(image))
+    with stage("find_planaria.label"):
+        label_objects, num_labels = ndi.label(binary)
+    areas = np.bincount(label_objects.ravel(), minlength=num_labels + 1)[1:]
+    kept = areas >= min_area
+    if max_area is not None:
+        kept &= areas <= max_area
+    # find_objects gets every bounding box in one pass over the label map
+    bboxes = np.array([(rows.start, rows.stop, cols.start, cols.stop)
+                       for rows, cols in ndi.find_objects(label_objects)], dtype=np.int64).reshape(-1, 4)
+    relabel = np.zeros(num_labels + 1, dtype=np.int32)
+    relabel[1:][kept] = np.arange(1, np.count_nonzero(kept) + 1)
+    return relabel[label_objects], areas[kept], bboxes[kept]
+
+
+def crop_object_masks(labels: np.ndarray, bboxes: np.ndarray, margin: int = 0) -> List[np.ndarray]:
+    # every mask is cut from its own bounding box, widened by margin, so no pass touches the full image
+    masks = []
+    for object_id, (row_start, row_end, col_start, col_end) in enumerate(bboxes.tolist(), start=1):
+        row_start, col_start = max(row_start - margin, 0), max(col_start - margin, 0)
+        row_end, col_end = min(row_end + margin, labels.shape[0]), min(col_end + margin, labels.shape[1])
+        masks.append(labels[row_start:row_end, col_start:col_end] == object_id)
+    return masks
+
+
+@instrumented("find_planaria_fast")
+def find_planaria_fast(image: np.ndarray, downscale: int = 1, margin: int = 32) -> np.ndarray:
+    gray = to_gray(image)
+    if downscale <= 1:
+        return detect_planaria_mask(gray)
+
+    # coarse pass on a block-averaged image only locates the worm
+    height, width = gray.shape[0] // downscale * downscale, gray.shape[1] // downscale * downscale
+    small = gray[:height, :width].reshape(height // downscale, downscale, width // downscale, downscale)
+    small = small.mean(axis=(1, 3))
+    small_mask = detect_planaria_mask(small, sigma=max(3 / downscale, 1), dilation_size=max(5 // downscale, 1) | 1)
+    mask = np.zeros(gray.shape, dtype=bool)
+    rows, cols = np.flatnonzero(small_mask.any(axis=1)), np.flatnonzero(small_mask.any(axis=0))
+    if len(rows) == 0:
+        return mask
+
+    # fine pass at full resolution inside the bounding box only
+    row_start = max(rows[0] * downscale - margin, 0)
+    row_end = min((rows[-1] + 1) * downscale + margin, gray.shape[0])
+    col_start = max(cols[0] * downscale - margin, 0)
+    col_end = min((cols[-1] + 1) * downscale + margin, gray.shape[1])
+    mask[row_start:row_end, col_start:col_end] = detect_planaria_mask(gray[row_start:row_end, col_start:col_end])
+    return mask
+
+
+def masks_iou(mask_1: np.ndarray, mask_2: np.ndarray) -> float:
+    mask_1, mask_2 = mask_1 > 0, mask_2 > 0
+    union = np.count_nonzero(mask_1 | mask_2)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(mask_1 & mask_2) / union
+
+
+def find_planaria_fast_iou(image: np.ndarray, downscale: int = 1, margin: int = 32) -> float:
+    return masks_iou(find_planaria(image), find_planaria_fast(image, downscale=downscale, margin=margin))
+
+
 def planaria_from_file(photo_path: str) -> np.ndarray:
-    image = io.imread(photo_path)
+    with stage("decode_image"):
+        image = io.imread(photo_path)
     binary = find_planaria(image)
     return binary
 
 
-def segment_planaria_photo(photo_path: str, segmentation_path: str) -> None:
+def segment_planaria_photo(photo_path: str, segmentation_path: str, tile_size: Optional[int] = None) -> None:
+    if tile_size is not None:
+        segment_planaria_photo_tiled(photo_path, segmentation_path, tile_size=tile_size)
+        return
     planaria = planaria_from_file(photo_path)
-    io.imsave(segmentation_path, img_as_ubyte(1 - planaria))
+    with stage("save_segmentation"):
+        io.imsave(segmentation_path, img_as_ubyte(1 - planaria))
+
+
+def segment_planaria_photo_objects(photo_path: str, segmentation_dir: str, min_area: int = 1000,
+                                   max_area: Optional[int] = None, margin: int = 8) -> List[Dict]:
+    # Every worm of the photo goes to <sample>_<n>.bmp in segmentation_dir as a mask cropped to its
+    # bounding box plus margin; <sample>_objects.json keeps the boxes in photo coordinates.
+    with stage("decode_image"):
+        image = io.imread(photo_path)
+    labels, areas, bboxes = find_planaria_objects(image, min_area=min_area, max_area=max_area)
+    os.makedirs(segmentation_dir, exist_ok=True)
+    sample_name = os.path.splitext(os.path.basename(photo_path))[0]
+    objects = []
+    with stage("save_segmentation"):
+        for object_id, mask in enumerate(crop_object_masks(labels, bboxes, margin=margin), start=1):
+            object_path = os.path.join(segmentation_dir, "{}_{}.bmp".format(sample_name, object_id))
+            io.imsave(object_path, img_as_ubyte(1 - mask.astype(float)), check_contrast=False)
+            objects.append({"path": os.path.basename(object_path), "area": int(areas[object_id - 1]),
+                            "bbox": bboxes[object_id - 1].tolist(), "margin": margin})
+        with open(os.path.join(segmentation_dir, sample_name + "_objects.json"), "w") as f:
+            json.dump(objects, f, indent=1)
+    return objects
+
 
+SEGMENTATION_MANIFEST = "segmentation_manifest.json"
 
-def segment_planaria_directory(photo_dir: str, segmentation_dir: str) -> None:
-    if os.path.exists(segmentation_dir):
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(segmentation_dir: str) -> Dict[str, str]:
+    manifest_path = os.path.join(segmentation_dir, SEGMENTATION_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return dict()
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(segmentation_dir: str, manifest: Dict[str, str]) -> None:
+    manifest_path = os.path.join(segmentation_dir, SEGMENTATION_MANIFEST)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def is_segmentation_actual(photo_path: str, segmentation_path: str, incremental: Optional[str],
+                           manifest: Dict[str, str], photo_hash: Optional[str]) -> bool:
+    if incremental is None or not os.path.exists(segmentation_path):
+        return False
+    if incremental == "mtime":
+        return os.path.getmtime(segmentation_path) >= os.path.getmtime(photo_path)
+    return manifest.get(os.path.basename(photo_path)) == photo_hash
+
+
+def _segment_photo_task(task: Tuple[str, str, Optional[int]]) -> Tuple[str, Optional[str]]:
+    photo_path, segmentation_path, tile_size = task
+    try:
+        segment_planaria_photo(photo_path=photo_path, segmentation_path=segmentation_path, tile_size=tile_size)
+    except Exception as e:
+        return photo_path, "{}: {}".format(type(e).__name__, e)
+    return photo_path, None
+
+
+def run_segmentation_tasks(tasks: List[Tuple[str, str]], n_jobs: int = 1,
+                           tile_size: Optional[int] = None) -> Dict[str, Optional[str]]:
+    tasks = [(photo_path, segmentation_path, tile_size) for photo_path, segmentation_path in tasks]
+    if n_jobs == 1 or len(tasks) <= 1:
+        return dict(_segment_photo_task(task) for task in tasks)
+    errors = dict()
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        for task_result in executor.map(InstrumentedTask(_segment_photo_task), tasks, chunksize=4):
+            photo_path, error = unwrap(task_result)
+            errors[photo_path] = error
+    return errors
+
+
+def prepare_segmentation_directory(photo_dir: str, segmentation_dir: str, incremental: Optional[str] = None):
+    assert incremental in [None, "mtime", "hash"]
+    if incremental is None and os.path.exists(segmentation_dir):
         rmtree(segmentation_dir)
-    os.mkdir(segmentation_dir)
+    os.makedirs(segmentation_dir, exist_ok=True)
+    manifest = read_manifest(segmentation_dir) if incremental == "hash" else dict()
     photo_files = [os.path.join(photo_dir, x) for x in os.listdir(photo_dir) if x.endswith('bmp')]
+    tasks, skipped, photo_hashes = [], [], dict()
     for photo_path in photo_files:
         segmentation_path = os.path.join(segmentation_dir, os.path.split(photo_path)[-1])
-        segment_planaria_photo(photo_path=photo_path, segmentation_path=segmentation_path)
+        photo_hash = file_hash(photo_path) if incremental == "hash" else None
+        if is_segmentation_actual(photo_path, segmentation_path, incremental, manifest, photo_hash):
+            skipped.append(photo_path)
+            continue
+        tasks.append((photo_path, segmentation_path))
+        photo_hashes[photo_path] = photo_hash
+    return tasks, skipped, manifest, photo_hashes
+
+
+def new_segmentation_summary() -> Dict:
+    return {"segmented": [], "skipped": [], "failed": dict()}
+
+
+def segment_planaria_directories(directories: List[Tuple[str, str]], n_jobs: int = 1,
+                                 incremental: Optional[str] = None, tile_size: Optional[int] = None) -> Dict:
+    summary = new_segmentation_summary()
+    tasks, manifests = [], []
+    for photo_dir, segmentation_dir in directories:
+        dir_tasks, skipped, manifest, photo_hashes = prepare_segmentation_directory(photo_dir, segmentation_dir,
+                                                                                    incremental)
+        tasks.extend(dir_tasks)
+        summary["skipped"].extend(skipped)
+        manifests.append((segmentation_dir, manifest, photo_hashes))
+
+    errors = run_segmentation_tasks(tasks, n_jobs=n_jobs, tile_size=tile_size)
+    for photo_path, _ in tasks:
+        if errors[photo_path] is None:
+            summary["segmented"].append(photo_path)
+        else:
+            summary["failed"][photo_path] = errors[photo_path]
+
+    if incremental == "hash":
+        for segmentation_dir, manifest, photo_hashes in manifests:
+            for photo_path, photo_hash in photo_hashes.items():
+                if errors[photo_path] is None:
+                    manifest[os.path.basename(photo_path)] = photo_hash
+                else:
+                    manifest.pop(os.path.basename(photo_path), None)
+            write_manifest(segmentation_dir, manifest)
+    return summary
+
+
+def print_segmentation_summary(summary: Dict) -> None:
+    print("segmented: {}, skipped: {}, failed: {}".format(len(summary["segmented"]), len(summary["skipped"]),
+                                                         len(summary["failed"])))
+    for photo_path, error in summary["failed"].items():
+        print("failed {}: {}".format(photo_path, error))
+
+
+def segment_planaria_directory(photo_dir: str, segmentation_dir: str, n_jobs: int = 1,
+                               incremental: Optional[str] = None, tile_size: Optional[int] = None) -> Dict:
+    return segment_planaria_directories([(photo_dir, segmentation_dir)], n_jobs=n_jobs, incremental=incremental,
+                                        tile_size=tile_size)
 
 
 def segment_all_photos(all_photos_dir: str = PLANARIA_PHOTO_DIR_PATH,
-                       segmentation_dir: str = PLANARIA_SEGMENTATION_DIR_PATH) -> None:
+                       segmentation_dir: str = PLANARIA_SEGMENTATION_DIR_PATH,
+                       n_jobs: int = 1, incremental: Optional[str] = None, verbose: bool = True,
+                       tile_size: Optional[int] = None) -> Dict:
+    directories = []
     for directory in os.listdir(all_photos_dir):
         photo_directory = os.path.join(all_photos_dir, directory)
         if not os.path.isdir(photo_directory):
             continue
         segmentation_directory = os.path.join(segmentation_dir, directory)
-        segment_planaria_directory(photo_dir=photo_directory, segmentation_dir=segmentation_directory)
+        directories.append((photo_directory, segmentation_directory))
+    summary = segment_planaria_directories(directories, n_jobs=n_jobs, incremental=incremental, tile_size=tile_size)
+    if verbose:
+        print_segmentation_summary(summary)
+    return summary
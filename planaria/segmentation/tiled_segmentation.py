@@ -0,0 +1,187 @@
+import struct
+import tempfile
+from typing import Iterator, List, Optional, Tuple
+import numpy as np
+from skimage import io, util, color, feature
+from scipy import ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from planaria.instrumentation import stage
+
+BMP_HEADER_SIZE = 14
+BMP_INFO_SIZE = 40
+
+
+def open_image(photo_path: str) -> np.ndarray:
+    # uncompressed 24/32-bit BMP files are mapped instead of read, so tiles are loaded on demand
+    with open(photo_path, "rb") as f:
+        header = f.read(BMP_HEADER_SIZE + BMP_INFO_SIZE)
+    if len(header) == BMP_HEADER_SIZE + BMP_INFO_SIZE and header[:2] == b"BM":
+        data_offset, = struct.unpack_from("<I", header, 10)
+        width, height, _, bits, compression = struct.unpack_from("<iiHHI", header, 18)
+        if compression == 0 and bits in [24, 32]:
+            channels = bits // 8
+            row_size = (bits * width + 31) // 32 * 4
+            rows = np.memmap(photo_path, dtype=np.uint8, mode="r", offset=data_offset, shape=(abs(height), row_size))
+            image = rows[:, :width * channels].reshape(abs(height), width, channels)[:, :, 2::-1]
+            # positive height means the rows are stored bottom-up
+            return image[::-1] if height > 0 else image
+    return io.imread(photo_path)
+
+
+def create_mask_bmp(segmentation_path: str, shape: Tuple[int, int]) -> np.ndarray:
+    # 8-bit grayscale BMP mapped for writing, the layout io.imsave gives a uint8 mask
+    height, width = shape
+    row_size = (width + 3) // 4 * 4
+    data_offset = BMP_HEADER_SIZE + BMP_INFO_SIZE + 256 * 4
+    with open(segmentation_path, "wb") as f:
+        f.write(b"BM" + struct.pack("<IHHI", data_offset + row_size * height, 0, 0, data_offset))
+        f.write(struct.pack("<IiiHHIIiiII", BMP_INFO_SIZE, width, height, 1, 8, 0, row_size * height,
+                            2835, 2835, 256, 256))
+        f.write(bytes(bytearray(value for gray in range(256) for value in (gray, gray, gray, 0))))
+        f.truncate(data_offset + row_size * height)
+    rows = np.memmap(segmentation_path, dtype=np.uint8, mode="r+", offset=data_offset, shape=(height, row_size))
+    return rows[::-1, :width]
+
+
+class InvertedMaskWriter:
+    # writes boolean tiles as 0 for planaria and 255 for background, as segment_planaria_photo does
+    def __init__(self, image: np.ndarray):
+        self.image = image
+        self.shape = image.shape
+
+    def __setitem__(self, key, mask: np.ndarray):
+        self.image[key] = np.where(mask, 0, 255).astype(np.uint8)
+
+
+def iter_tiles(shape: Tuple[int, int], tile_size: int) -> Iterator[Tuple[int, int, slice, slice]]:
+    for tile_row, row_start in enumerate(range(0, shape[0], tile_size)):
+        for tile_col, col_start in enumerate(range(0, shape[1], tile_size)):
+            yield tile_row, tile_col, slice(row_start, min(row_start + tile_size, shape[0])), \
+                slice(col_start, min(col_start + tile_size, shape[1]))
+
+
+def detect_edges_tile(image: np.ndarray, rows: slice, cols: slice, halo: int, sigma: float = 3,
+                      dilation_size: int = 5) -> np.ndarray:
+    # canny and dilation of find_planaria on the tile extended by the halo, cropped back to the tile
+    row_start, col_start = max(rows.start - halo, 0), max(cols.start - halo, 0)
+    row_end, col_end = min(rows.stop + halo, image.shape[0]), min(cols.stop + halo, image.shape[1])
+    tile = util.img_as_float(np.asarray(image[row_start:row_end, col_start:col_end]))
+    gray = color.rgb2gray(tile) if tile.ndim == 3 else tile
+    with stage("find_planaria.canny"):
+        edges = feature.canny(gray, sigma=sigma)
+    binary = ndi.binary_dilation(edges, structure=np.ones((dilation_size, dilation_size), dtype=bool))
+    return binary[rows.start - row_start:rows.stop - row_start, cols.start - col_start:cols.stop - col_start]
+
+
+def label_tile(binary: np.ndarray) -> Tuple[np.ndarray, int, int]:
+    # foreground and background components (4-connected, as ndi.label and binary_fill_holes use)
+    # in one map: foreground 0..num_foreground-1, background after them
+    foreground, num_foreground = ndi.label(binary)
+    background, num_background = ndi.label(~binary)
+    labels = np.where(binary, foreground - 1, background + num_foreground - 1)
+    return labels, num_foreground, num_background
+
+
+def _adjacent_pairs(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    return np.unique(np.stack([first.ravel(), second.ravel()], axis=1), axis=0)
+
+
+def find_planaria_tiled(image: np.ndarray, tile_size: int = 2048, halo: int = 32, out=None,
+                        work_dir: Optional[str] = None):
+    # find_planaria for images that do not fit in memory. Pass 1 runs canny and dilation per tile with a
+    # halo, keeps the dilated mask in a temporary memmap and labels the foreground and background of every
+    # tile; labels are joined across seams with a graph over tile-local components. Background components
+    # away from the image border are the holes that binary_fill_holes fills, they join the foreground they
+    # touch. Pass 2 relabels every tile and writes the largest filled component to out.
+    # With halo at least 4 * sigma + 2 the dilated mask matches the untiled one except for canny hysteresis
+    # chains longer than the halo that cross a seam.
+    shape = image.shape[:2]
+    if out is None:
+        out = np.zeros(shape, dtype=bool)
+    with tempfile.TemporaryFile(dir=work_dir) as binary_file:
+        binary_all = np.memmap(binary_file, dtype=bool, mode="w+", shape=shape)
+        tiles = list(iter_tiles(shape, tile_size))
+        num_tile_rows, num_tile_cols = tiles[-1][0] + 1, tiles[-1][1] + 1
+        tile_offsets = np.zeros((num_tile_rows, num_tile_cols), dtype=np.int64)
+        borders = dict()
+        sizes, is_foreground, pairs, on_border = [], [], [], []
+        num_labels = 0
+        for tile_row, tile_col, rows, cols in tiles:
+            binary = detect_edges_tile(image, rows, cols, halo)
+            binary_all[rows, cols] = binary
+            labels, num_foreground, num_background = label_tile(binary)
+            labels += num_labels
+            tile_offsets[tile_row, tile_col] = num_labels
+            sizes.append(np.bincount(labels.ravel() - num_labels, minlength=num_foreground + num_background))
+            is_foreground.append(np.arange(num_foreground + num_background) < num_foreground)
+            # foreground-background neighbours inside the tile
+            horizontal = binary[:, :-1] != binary[:, 1:]
+            vertical = binary[:-1] != binary[1:]
+            pairs.append(_adjacent_pairs(labels[:, :-1][horizontal], labels[:, 1:][horizontal]))
+            pairs.append(_adjacent_pairs(labels[:-1][vertical], labels[1:][vertical]))
+            # only the tile edges are kept, copied so the label map itself is freed
+            top, bottom, left, right = labels[0].copy(), labels[-1].copy(), labels[:, 0].copy(), labels[:, -1].copy()
+            borders[tile_row, tile_col] = (top, bottom, left, right)
+            if rows.start == 0:
+                on_border.append(top)
+            if rows.stop == shape[0]:
+                on_border.append(bottom)
+            if cols.start == 0:
+                on_border.append(left)
+            if cols.stop == shape[1]:
+                on_border.append(right)
+            num_labels += num_foreground + num_background
+
+        sizes, is_foreground = np.concatenate(sizes), np.concatenate(is_foreground)
+        # neighbours across the seams: same kind joins components, different kinds are adjacency pairs
+        seams = []
+        for (tile_row, tile_col), (top, bottom, left, right) in borders.items():
+            if tile_col + 1 < num_tile_cols:
+                seams.append((right, borders[tile_row, tile_col + 1][2]))
+            if tile_row + 1 < num_tile_rows:
+                seams.append((bottom, borders[tile_row + 1, tile_col][0]))
+        joins = []
+        for first, second in seams:
+            same = is_foreground[first] == is_foreground[second]
+            joins.append(_adjacent_pairs(first[same], second[same]))
+            pairs.append(_adjacent_pairs(first[~same], second[~same]))
+        components = _join_labels(num_labels, joins)
+
+        # holes are background components that do not reach the image border
+        is_hole = np.zeros(components.max() + 1, dtype=bool)
+        is_hole[components[~is_foreground]] = True
+        is_hole[components[np.concatenate(on_border)]] = False
+        pairs = np.concatenate(pairs + [np.empty((0, 2), dtype=np.int64)])
+        pairs = components[pairs]
+        pairs = pairs[is_hole[pairs[:, 0]] | is_hole[pairs[:, 1]]]
+        filled = _join_labels(len(is_hole), [pairs])[components]
+        kept = is_foreground | is_hole[components]
+        filled_sizes = np.bincount(filled[kept], weights=sizes[kept], minlength=filled.max() + 1)
+        selected = np.zeros(num_labels, dtype=bool)
+        if is_foreground.any():
+            # the largest filled component that has foreground in it
+            filled_sizes[~np.isin(np.arange(len(filled_sizes)), filled[is_foreground])] = -1
+            selected = kept & (filled == np.argmax(filled_sizes))
+
+        for tile_row, tile_col, rows, cols in tiles:
+            labels, _, _ = label_tile(np.asarray(binary_all[rows, cols]))
+            out[rows, cols] = selected[labels + tile_offsets[tile_row, tile_col]]
+        del binary_all
+    return out
+
+
+def _join_labels(num_labels: int, edge_lists: List[np.ndarray]) -> np.ndarray:
+    edges = np.concatenate(edge_lists + [np.empty((0, 2), dtype=np.int64)])
+    graph = coo_matrix((np.ones(len(edges), dtype=np.int8), (edges[:, 0], edges[:, 1])),
+                       shape=(num_labels, num_labels))
+    return connected_components(graph, directed=False)[1]
+
+
+def segment_planaria_photo_tiled(photo_path: str, segmentation_path: str, tile_size: int = 2048,
+                                 halo: int = 32, work_dir: Optional[str] = None) -> None:
+    with stage("decode_image"):
+        image = open_image(photo_path)
+    segmentation = create_mask_bmp(segmentation_path, image.shape[:2])
+    find_planaria_tiled(image, tile_size=tile_size, halo=halo, out=InvertedMaskWriter(segmentation), work_dir=work_dir)
+    segmentation.flush()
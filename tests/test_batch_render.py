@@ -0,0 +1,33 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from benchmarks.synthetic import write_skeleton_extra
+from planaria.preprocessing.batch_render import find_diagram_samples, render_diagrams
+from planaria.preprocessing.render import tile_images
+
+
+@pytest.fixture
+def diagram_dir(tmp_path):
+    write_skeleton_extra(str(tmp_path / "only_way_skeleton_extra.txt"), np.random.default_rng(0), 30)
+    return str(tmp_path)
+
+
+def test_sample_with_only_skeleton_way(diagram_dir, tmp_path):
+    samples = find_diagram_samples(diagram_dir)
+    assert [sample_name for sample_name, _ in samples] == ["only_way"]
+    output_paths = render_diagrams(samples, str(tmp_path / "out"))
+    assert output_paths == [os.path.join(str(tmp_path / "out"), "only_way.png")]
+    assert Image.open(output_paths[0]).size[0] > 0
+    assert len(render_diagrams(samples, str(tmp_path / "sheets"), samples_per_sheet=4)) == 1
+
+
+def test_sample_without_views_is_skipped(tmp_path):
+    samples = [("unknown", {"photo": str(tmp_path / "unknown.bmp")})]
+    assert render_diagrams(samples, str(tmp_path / "out")) == []
+    assert render_diagrams(samples, str(tmp_path / "sheets"), samples_per_sheet=4) == []
+
+
+def test_tile_images_empty():
+    with pytest.raises(ValueError):
+        tile_images([], columns=1)
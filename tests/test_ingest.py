@@ -0,0 +1,29 @@
+import os
+import asyncio
+import numpy as np
+from skimage import io
+from benchmarks.synthetic import synthetic_photo
+from planaria.ingest import IngestService, directory_class_label
+
+
+def test_directory_class_label():
+    assert directory_class_label("planaria 3") == 3
+    assert directory_class_label("unsorted") is None
+
+
+def test_unlabelled_directory_and_failing_callback(tmp_path):
+    photo_dir, segmentation_dir = tmp_path / "photo", tmp_path / "segmentation"
+    rng = np.random.default_rng(0)
+    for directory in ["planaria 1", "unsorted"]:
+        os.makedirs(photo_dir / directory)
+        io.imsave(str(photo_dir / directory / "x.bmp"), synthetic_photo((240, 320), rng), check_contrast=False)
+
+    def on_result(record):
+        raise RuntimeError("callback failed")
+
+    service = IngestService(str(photo_dir), str(segmentation_dir), n_jobs=1, poll_interval=0.05, settle_time=0.0,
+                            on_result=on_result)
+    asyncio.run(asyncio.wait_for(service.run(stop_when_idle=True), timeout=120))
+    assert list(service.records) == [os.path.join("planaria 1", "x.bmp")]
+    assert service.records[os.path.join("planaria 1", "x.bmp")]["status"] == "done"
+    assert not service._pending
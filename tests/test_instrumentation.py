@@ -0,0 +1,28 @@
+import os
+import sys
+import json
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CODE = """
+import json
+import numpy as np
+from planaria import instrumentation
+instrumentation.enable()
+with instrumentation.stage("heavy"):
+    block = np.ones(2 ** 25)
+    del block
+with instrumentation.stage("light"):
+    np.ones(16).sum()
+print(json.dumps(instrumentation.snapshot()))
+"""
+
+
+def test_stage_reports_its_own_peak_rss_increase():
+    # a fresh interpreter, so the peak left by other tests does not hide the heavy stage
+    output = subprocess.check_output([sys.executable, "-c", CODE], cwd=ROOT_DIR)
+    stats = json.loads(output.decode().splitlines()[-1])
+    # the heavy stage touched 256 MB; the light one runs below that mark and must not inherit it
+    assert stats["heavy"]["peak_rss_increase_bytes"] > 2 ** 27
+    assert stats["light"]["peak_rss_increase_bytes"] < 2 ** 22
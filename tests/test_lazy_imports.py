@@ -0,0 +1,30 @@
+import os
+import sys
+import json
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def imported_modules(code: str):
+    # a fresh interpreter, so modules loaded by other tests do not leak into sys.modules
+    code += "\nimport sys, json\nprint(json.dumps(list(sys.modules)))"
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT_DIR)
+    return set(json.loads(output.decode().splitlines()[-1]))
+
+
+def test_feature_imports_skip_drawing_dependencies():
+    modules = imported_modules("from planaria.preprocessing import SkeletonWay, FeaturePreprocesser")
+    assert "planaria.preprocessing.skeleton_way" in modules
+    assert "matplotlib" not in modules
+    assert "PIL" not in modules
+    assert "planaria.preprocessing.draw_data" not in modules
+
+
+def test_draw_data_resolves_lazily():
+    modules = imported_modules("import planaria.preprocessing as preprocessing\n"
+                               "assert preprocessing.draw_data.__name__ == 'planaria.preprocessing.draw_data'\n"
+                               "assert 'draw_data' in dir(preprocessing)")
+    assert "planaria.preprocessing.draw_data" in modules
+    # draw_data needs PIL, matplotlib only comes with plot_3_images
+    assert "PIL" in modules
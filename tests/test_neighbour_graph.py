@@ -0,0 +1,22 @@
+import numpy as np
+from planaria.preprocessing import SkeletonWay
+from planaria.modeling import neighbour_graph
+from planaria.modeling.shape_matching import ShapeMatcher
+
+
+def random_skeleton(rng: np.random.Generator) -> SkeletonWay:
+    num_nodes = int(rng.integers(2, 30))
+    x = np.cumsum(rng.uniform(0.5, 30, num_nodes))
+    return SkeletonWay.from_arrays(2, x, np.zeros(num_nodes), rng.uniform(1, 30, num_nodes))
+
+
+def test_serial_graph_matches_pairwise_matrix_and_releases_state():
+    rng = np.random.default_rng(0)
+    skeletons = [random_skeleton(rng) for _ in range(30)]
+    graph = neighbour_graph.build_neighbour_graph(skeletons, k=3, metric="absolute_diff", tile_size=8)
+    assert not neighbour_graph._worker_state
+    absolute_diff, _ = ShapeMatcher.pairwise_matrix(skeletons)
+    np.fill_diagonal(absolute_diff, np.inf)
+    for i in range(len(skeletons)):
+        _, distances = graph.neighbours(i)
+        assert np.allclose(distances, np.sort(absolute_diff[i])[:3], rtol=1e-10)
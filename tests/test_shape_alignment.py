@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic import synthetic_skeleton_way
+from planaria.preprocessing import SkeletonWay
+from planaria.modeling.shape_matching import ShapeMatcher, calculate_shifted_diffs, flip_profile, \
+    calculate_aligned_symmetric_diff
+
+
+def skeletons(num_skeletons: int):
+    rng = np.random.default_rng(0)
+    return [SkeletonWay.from_arrays(2, *synthetic_skeleton_way(rng, int(rng.integers(20, 60)),
+                                                               length=float(rng.uniform(300, 700))))
+            for _ in range(num_skeletons)]
+
+
+def test_zero_shift_matches_symmetric_diff_square():
+    skeletons_all = skeletons(20)
+    for skeleton_1, skeleton_2 in zip(skeletons_all[::2], skeletons_all[1::2]):
+        (x_1, radius_1), (x_2, radius_2) = skeleton_1.get_straight_profile(), skeleton_2.get_straight_profile()
+        assert np.isclose(calculate_shifted_diffs(x_1, radius_1, x_2, radius_2, np.zeros(1))[0],
+                          ShapeMatcher.calculate_symmetric_diff_square(skeleton_1, skeleton_2))
+
+
+def test_aligned_never_exceeds_unaligned():
+    skeletons_all = skeletons(40)
+    for skeleton_1, skeleton_2 in zip(skeletons_all[::2], skeletons_all[1::2]):
+        aligned, _, _ = ShapeMatcher.calculate_aligned_symmetric_diff(skeleton_1, skeleton_2)
+        assert aligned <= ShapeMatcher.calculate_symmetric_diff_square(skeleton_1, skeleton_2) * (1 + 1e-12)
+
+
+def test_flipped_copy():
+    skeleton = skeletons(1)[0]
+    x, radius = flip_profile(*skeleton.get_straight_profile())
+    flipped = SkeletonWay.from_arrays(2, x, np.zeros(len(x)), radius, straight_x=x, straight_radius=radius)
+    distance, is_flipped, shift = ShapeMatcher.calculate_aligned_symmetric_diff(skeleton, flipped)
+    assert is_flipped and shift == 0.0 and np.isclose(distance, 0.0, atol=1e-9)
+
+
+def test_refine_rounds_validated():
+    (x_1, radius_1), (x_2, radius_2) = [skeleton.get_straight_profile() for skeleton in skeletons(2)]
+    with pytest.raises(ValueError):
+        calculate_aligned_symmetric_diff(x_1, radius_1, x_2, radius_2, refine_rounds=0)
+    with pytest.raises(ValueError):
+        calculate_aligned_symmetric_diff(x_1, radius_1, x_2, radius_2, refine_points=0)
+    aligned, _, _ = calculate_aligned_symmetric_diff(x_1, radius_1, x_2, radius_2, refine_rounds=1)
+    assert np.isfinite(aligned)
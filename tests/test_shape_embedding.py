@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+from planaria.preprocessing import SkeletonWay
+from planaria.modeling.shape_embedding import ProfileEmbedder
+
+
+def skeleton(length: float) -> SkeletonWay:
+    x = np.linspace(0.0, length, 20)
+    return SkeletonWay.from_arrays(2, x, np.zeros(20), np.full(20, 10.0))
+
+
+def test_transform_rejects_longer_profiles():
+    embedder = ProfileEmbedder(num_points=64).fit([skeleton(100.0), skeleton(200.0)])
+    assert embedder.transform([skeleton(150.0)]).shape == (1, 64)
+    with pytest.raises(ValueError):
+        embedder.transform([skeleton(300.0)])
+
+
+def test_transform_clips_on_request():
+    embedder = ProfileEmbedder(num_points=64, clip=True).fit([skeleton(100.0)])
+    embeddings = embedder.transform([skeleton(300.0)])
+    # cut at the end of the grid, the profile never falls to zero
+    assert embeddings[0, -1] == 10.0
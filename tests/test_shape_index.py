@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic import synthetic_skeleton_way
+from planaria.preprocessing import SkeletonWay
+from planaria.modeling.shape_matching import ShapeMatcher
+from planaria.modeling.shape_index import ShapeIndex
+
+
+def random_skeleton(rng: np.random.Generator) -> SkeletonWay:
+    num_nodes = int(rng.integers(2, 30))
+    x = np.cumsum(rng.uniform(0.5, 30, num_nodes))
+    return SkeletonWay.from_arrays(2, x, np.zeros(num_nodes), rng.uniform(1, 30, num_nodes))
+
+
+def synthetic_skeleton(rng: np.random.Generator) -> SkeletonWay:
+    return SkeletonWay.from_arrays(2, *synthetic_skeleton_way(rng, int(rng.integers(20, 60)),
+                                                              length=float(rng.uniform(300, 700))))
+
+
+@pytest.fixture(params=[random_skeleton, synthetic_skeleton], ids=["random", "synthetic"])
+def references(request):
+    rng = np.random.default_rng(0)
+    skeletons = [request.param(rng) for _ in range(160)]
+    absolute_diff, _ = ShapeMatcher.pairwise_matrix(skeletons)
+    return skeletons, np.asarray(absolute_diff)
+
+
+def test_index_counterexample():
+    # the ramp tail makes |square_1 - square_2| larger than the distance here
+    skeleton_1 = SkeletonWay.from_arrays(2, np.array([0.0, 0.0, 10.0]), np.zeros(3), np.array([0.0, 0.0, 10.0]))
+    skeleton_2 = SkeletonWay.from_arrays(2, np.array([0.0, 0.0, 10.0, 20.0]), np.zeros(4),
+                                         np.array([0.0, 0.0, 10.0, 10.0]))
+    ids, distances = ShapeIndex([skeleton_2]).range_query(skeleton_1, 150.0)
+    assert ids.tolist() == [0]
+    assert np.isclose(distances[0], ShapeMatcher.calculate_symmetric_diff_square(skeleton_1, skeleton_2))
+
+
+def test_query_matches_brute_force(references):
+    skeletons, absolute_diff = references
+    index = ShapeIndex(skeletons[:120], leaf_size=8)
+    for query in range(120, 160):
+        distances = absolute_diff[query, :120]
+        for k in [1, 5]:
+            ids, found = index.query(skeletons[query], k)
+            assert np.allclose(found, np.sort(distances)[:k])
+            assert np.allclose(distances[ids], found)
+
+
+def test_range_query_matches_brute_force(references):
+    skeletons, absolute_diff = references
+    index = ShapeIndex(skeletons[:120], leaf_size=8)
+    for query in range(120, 160):
+        distances = absolute_diff[query, :120]
+        max_distance = np.quantile(distances, 0.1)
+        ids, found = index.range_query(skeletons[query], max_distance)
+        assert sorted(ids.tolist()) == np.flatnonzero(distances <= max_distance).tolist()
+        assert np.allclose(distances[ids], found)
@@ -0,0 +1,27 @@
+import numpy as np
+from planaria.preprocessing import SkeletonWay
+from planaria.modeling.shape_matching import ShapeMatcher
+
+
+def random_skeleton(rng: np.random.Generator, num_nodes: int) -> SkeletonWay:
+    x = np.cumsum(rng.uniform(0.5, 30, num_nodes))
+    return SkeletonWay.from_arrays(2, x, np.zeros(num_nodes), rng.uniform(1, 30, num_nodes))
+
+
+def test_symmetric_diff_is_symmetric():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        skeleton_1 = random_skeleton(rng, int(rng.integers(2, 10)))
+        skeleton_2 = random_skeleton(rng, int(rng.integers(10, 30)))
+        diff_12 = ShapeMatcher.calculate_symmetric_diff_square(skeleton_1, skeleton_2)
+        diff_21 = ShapeMatcher.calculate_symmetric_diff_square(skeleton_2, skeleton_1)
+        assert np.isclose(diff_12, diff_21, rtol=1e-12, atol=0)
+
+
+def test_pairwise_matrix_matches_scalar_diff():
+    rng = np.random.default_rng(1)
+    skeletons = [random_skeleton(rng, num_nodes) for num_nodes in [2, 3, 7, 12, 25, 40]]
+    absolute_diff, _ = ShapeMatcher.pairwise_matrix(skeletons)
+    expected = np.array([[ShapeMatcher.calculate_symmetric_diff_square(skeleton_1, skeleton_2)
+                          for skeleton_2 in skeletons] for skeleton_1 in skeletons])
+    assert np.allclose(absolute_diff, expected, rtol=1e-10, atol=1e-9)
@@ -0,0 +1,40 @@
+import numpy as np
+from planaria.preprocessing import SkeletonWay, SkeletonCollection
+from planaria.preprocessing.preprocessing import calculate_features_columns
+
+
+def random_collection():
+    rng = np.random.default_rng(0)
+    skeletons = []
+    for _ in range(2000):
+        num_nodes = int(rng.integers(1, 60))
+        x, y = 1000 + np.cumsum(rng.uniform(0, 10, num_nodes)), np.cumsum(rng.uniform(0, 10, num_nodes))
+        # repeated points give zero-length edges
+        repeated = np.flatnonzero(rng.random(num_nodes) < 0.1)
+        repeated = repeated[repeated > 0]
+        x[repeated], y[repeated] = x[repeated - 1], y[repeated - 1]
+        skeletons.append(SkeletonWay.from_arrays(2, x, y, rng.uniform(1, 30, num_nodes)))
+    collection = SkeletonCollection.from_skeletons(skeletons, [1] * len(skeletons),
+                                                   [str(i) for i in range(len(skeletons))])
+    collection.straighten()
+    return skeletons, collection
+
+
+def test_straighten_matches_skeleton_way():
+    skeletons, collection = random_collection()
+    for i, skeleton in enumerate(skeletons):
+        straight_x, straight_radius = collection.get_skeleton(i).get_straight_profile()
+        # equal to the per-skeleton cumsum within rounding at the scale of one profile
+        assert np.allclose(straight_x, skeleton.get_straight_profile()[0], rtol=1e-12, atol=0)
+        assert np.array_equal(straight_radius, skeleton.get_straight_profile()[1])
+
+
+def test_features_match_skeleton_way():
+    skeletons, collection = random_collection()
+    # single-node skeletons have zero length, their mean radius is NaN on both sides
+    with np.errstate(invalid="ignore"):
+        features = collection.get_features()
+        columns = calculate_features_columns(skeletons)
+    # segmented sums round differently from the per-skeleton ones, equal within rounding only
+    for key, column in columns.items():
+        assert np.allclose(features[key], column, rtol=1e-10, atol=0, equal_nan=True)
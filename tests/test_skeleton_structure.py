@@ -0,0 +1,16 @@
+import numpy as np
+from planaria.preprocessing.skeleton_structure import Skeleton
+
+
+def test_prune_peels_nested_branches():
+    # main path 0-6 along x, a branch 3-7-8 upwards and a spur 7-9 on it
+    points = np.array([[x, 0.0] for x in range(7)] + [[3.0, 1.0], [3.0, 2.0], [4.0, 1.0]])
+    first_nodes = np.array([0, 1, 2, 3, 4, 5, 3, 7, 7])
+    second_nodes = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9])
+    skeleton = Skeleton.from_arrays(np.arange(10) + 100, points, np.ones(10), first_nodes, second_nodes)
+    # the first round drops 7-8 and keeps 7-9, as 7 is left with two branches; 9-7-3 goes in the second one
+    pruned = skeleton.prune(min_length=2.5)
+    assert np.array_equal(pruned.node_ids, np.arange(7) + 100)
+    assert pruned.num_terminals == 2
+    # branches as long as the main path ends stay
+    assert len(skeleton.prune(min_length=1.5).node_ids) == 9
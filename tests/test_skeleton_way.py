@@ -0,0 +1,31 @@
+import numpy as np
+from planaria.preprocessing import SkeletonWay
+
+
+def loop_features(x: np.ndarray, y: np.ndarray, radius: np.ndarray) -> dict:
+    # features as the per-node loops computed them before the one-pass kernel
+    straight_x, straight_radius = [0.0], [0.0]
+    for i in range(1, len(x)):
+        edge_length = ((x[i] - x[i - 1]) ** 2 + (y[i] - y[i - 1]) ** 2) ** 0.5
+        if edge_length == 0:
+            continue
+        straight_x.append(straight_x[-1] + edge_length)
+        straight_radius.append(radius[i])
+    square = 0
+    for i in range(1, len(straight_x)):
+        square += (straight_x[i] - straight_x[i - 1]) * (straight_radius[i - 1] + straight_radius[i])
+    return {"skeleton_length": straight_x[-1], "skeleton_square": square,
+            "skeleton_mean_radius": square / 2 / straight_x[-1], "skeleton_max_radius": np.max(straight_radius),
+            "skeleton_median_radius": np.median(straight_radius), "skeleton_num_lines": len(straight_x)}
+
+
+def test_features_match_loop_implementation():
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        num_nodes = int(rng.integers(2, 60))
+        x, y = 1000 + np.cumsum(rng.uniform(0, 10, num_nodes)), np.cumsum(rng.uniform(0, 10, num_nodes))
+        radius = rng.uniform(1, 30, num_nodes)
+        features = SkeletonWay.from_arrays(2, x, y, radius).get_features()
+        # hypot and dot round differently from the loops, so values agree to rounding, not bit for bit
+        for key, value in loop_features(x, y, radius).items():
+            assert np.isclose(features[key], value, rtol=1e-12, atol=0)